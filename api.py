@@ -1,26 +1,33 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends, BackgroundTasks, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends, Form, status
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from pydantic import BaseModel
 from starlette.datastructures import FormData
 
-from typing import Optional, Union, Dict, Any
+from typing import Optional, Union, Dict, Any, Tuple
 from json import JSONDecodeError
+from concurrent.futures import Future, ProcessPoolExecutor
+import asyncio
+import multiprocessing
 import tempfile
+import time
+import zlib
 import os
 import logging
 
 # ROUTER & LOGIC IMPORTS
-from document_check import router as document_router
+from document_check import router as document_router, start_client, close_client
 from pdf_reader import extract_text_from_pdf
 from llm_agent import extract_data_from_text
 from db_data import (
-    record_data,
-    get_status_by_recid,
+    arecord_data,
+    aget_status_by_recid,
     update_status,
-    save_extraction_results
+    aupdate_status,
+    save_and_complete,
+    load_status_map
 )
 from data_utils import extract_data_from_file
 
@@ -32,6 +39,33 @@ app = FastAPI(
 
 app.include_router(document_router)
 
+
+# Processi dedicati a OCR + LLM, così il lavoro CPU-bound non occupa il
+# threadpool di FastAPI e gli endpoint (es. /status) restano reattivi
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", str(os.cpu_count() or 1)))
+
+
+@app.on_event("startup")
+async def _startup():
+    await start_client()
+    # Tabella Status in memoria; se il DB non risponde verrà caricata al primo uso
+    try:
+        await asyncio.to_thread(load_status_map)
+    except Exception as e:
+        logging.warning(f"Impossibile caricare la tabella Status all'avvio: {e}")
+    # "spawn": i processi figli non ereditano connessioni ODBC e client HTTP del padre
+    app.state.pool = ProcessPoolExecutor(
+        max_workers=PIPELINE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await close_client()
+    # Attende le elaborazioni in corso, altrimenti i record resterebbero "In elaborazione"
+    await asyncio.to_thread(app.state.pool.shutdown)
+
 # Schema di sicurezza
 security = HTTPBearer()
 
@@ -43,15 +77,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Dimensione dei blocchi usati per copiare gli upload su disco
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Sotto questa soglia gli upload elaborati in tempo reale restano in memoria
+SPOOL_MAX_SIZE = 8 << 20
+# Estensioni accettate da /upload-pdf (senza punto, minuscole)
+_ALLOWED_EXT = frozenset({"pdf", "png", "jpg", "jpeg"})
+
+
+async def _save_upload(upload: UploadFile, suffix: str) -> str:
+    """
+    Copia il file caricato in un file temporaneo a blocchi di UPLOAD_CHUNK_SIZE,
+    senza materializzare l'intero contenuto in memoria. Restituisce il percorso.
+    Se la copia non riesce il file temporaneo viene eliminato.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+        return tmp.name
+
+
+def _log_task_error(recid: int):
+    """Callback per i Future del pool: registra gli errori non gestiti dal task."""
+    def callback(future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Errore nel processo di elaborazione per RecId {recid}: {future.exception()}")
+    return callback
 
 
 def process_pdf_background(tmp_path: str, recid: int, model: str, provider: str):
     try:
         result = extract_data_from_file(tmp_path, model, provider)
 
-        # Salvataggio nel DB (assicurati che questa funzione sia presente nel tuo db_data.py)
-        save_extraction_results(recid, result["text"], result["data"])
-        update_status(recid, 4)  # Successo
+        # Salvataggio nel DB e passaggio a "Elaborato" con un solo UPDATE
+        save_and_complete(recid, result["text"], result["data"], 4)  # Successo
 
     except Exception as e:
         logging.error(f"Errore nel background task per RecId {recid}: {e}")
@@ -83,18 +147,17 @@ async def upload_pdf(
                         file: UploadFile = File(...)
                         #, model: str = "gpt-3.5-turbo", provider: str = "openai" 
                         ):
-    if not file.filename.lower().endswith((".pdf", ".png", ".jpg", ".jpeg")):
+    suffix = os.path.splitext(file.filename or "")[1]
+    if suffix[1:].lower() not in _ALLOWED_EXT:
         raise HTTPException(status_code=400, detail="Formato non supportato. Usa PDF o immagine.")
     
     tmp_path = ""
     try:
         # 1. Salva il file temporaneamente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
+        tmp_path = await _save_upload(file, suffix)
 
         # 2. Registra nel database
-        recid, status = record_data(tmp_path, file.filename)
+        recid, status = await arecord_data(tmp_path, file.filename, None)
 
 
 
@@ -118,6 +181,30 @@ async def upload_pdf(
 
 
 
+# Ultimo stato noto per RecId, usato per rispondere 304 senza query al DB.
+# TTL breve: un cambio di stato viene visto al più dopo STATUS_CACHE_TTL secondi.
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "2"))
+STATUS_CACHE_SIZE = 10000
+_status_cache: Dict[int, Tuple[float, str]] = {}
+
+
+def _cache_status(recid: int, status: str) -> None:
+    _status_cache.pop(recid, None)
+    if len(_status_cache) >= STATUS_CACHE_SIZE:
+        _status_cache.pop(next(iter(_status_cache)))
+    _status_cache[recid] = (time.monotonic() + STATUS_CACHE_TTL, status)
+
+
+def _status_etag(status: str) -> str:
+    # Hash della descrizione: gli header devono restare ASCII anche con lettere accentate
+    return f'W/"{zlib.crc32(status.encode("utf-8")):08x}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags or etag[2:] in tags
+
+
 @app.get(
     "/status/{recid}",
     summary="Get Status",
@@ -131,14 +218,34 @@ Controlla lo stato di elaborazione del documento con `RecId`.
 - "Non Trovato"
 
 Utile per verificare se l'elaborazione asincrona è completata.
+
+🔁 Polling: la risposta contiene l'header `ETag`. Inviandolo nelle richieste
+successive come `If-None-Match` si riceve `304 Not Modified` (senza corpo)
+finché lo stato non cambia.
 """
 )
-def get_status(recid: int):
+async def get_status(recid: int, request: Request):
+    if_none_match = request.headers.get("if-none-match")
     try:
-        status = get_status_by_recid(recid)
+        # Entro STATUS_CACHE_TTL una richiesta condizionale non interroga il DB
+        cached = _status_cache.get(recid)
+        if if_none_match and cached and cached[0] > time.monotonic():
+            etag = _status_etag(cached[1])
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+
+        status = await aget_status_by_recid(recid)
         if status is None:
+            _status_cache.pop(recid, None)
             raise HTTPException(status_code=404, detail="RecId non trovato")
-        return {"recid": recid, "status": status}
+        _cache_status(recid, status)
+
+        etag = _status_etag(status)
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse({"recid": recid, "status": status}, headers={"ETag": etag})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -161,13 +268,13 @@ Utile per test o casi in cui non serve storicizzare i dati.
 )
 async def extract_data(file: UploadFile = File(...), model: str = "gpt-3.5-turbo", provider: str = "openai"):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(await file.read())
-            temp_path = temp_file.name
-
-        result = extract_data_from_file(temp_path, model, provider)
+        # I file piccoli restano in RAM, solo quelli grandi finiscono su disco
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+            # OCR e LLM sono bloccanti: in un thread, per non fermare l'event loop
+            result = await asyncio.to_thread(extract_data_from_file, spool, model, provider)
 
-        os.unlink(temp_path)
         return result
 
     except FileNotFoundError as e:
@@ -178,14 +285,6 @@ async def extract_data(file: UploadFile = File(...), model: str = "gpt-3.5-turbo
         raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione: {str(e)}")
     
 
-from typing import Optional
-import os
-import tempfile
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, status
-from fastapi.responses import JSONResponse
-from db_data import record_data, save_extraction_results, update_status
-from data_utils import extract_data_from_file
-
 
 # Da eliminare prova Danilo
 #def _process_pipeline_background_BCK(
@@ -247,14 +346,12 @@ async def decode_body(request: Request) -> Union[dict, FormData]:
 # --- [2] Task eseguito in background (solo se esiste file) ---
 def _process_pipeline_background(tmp_path: Optional[str], recid: int, user_prompt: Optional[str]):
     try:
-        
-        update_status(recid, 2)  # "In elaborazione"
-
+        # Il record è già stato inserito con stato 2 ("In elaborazione")
         if tmp_path:
             result = extract_data_from_file(tmp_path, model="gpt-3.5-turbo", provider="openai")
-            save_extraction_results(recid, result["text"], result["data"])
-        
-        update_status(recid, 4)  # "Elaborato"
+            save_and_complete(recid, result["text"], result["data"], 4)  # "Elaborato"
+        else:
+            update_status(recid, 4)  # "Elaborato"
     except Exception as e:
         update_status(recid, 98)  # "Errore"
         # qui puoi fare log dell'errore se vuoi
@@ -266,7 +363,6 @@ def _process_pipeline_background(tmp_path: Optional[str], recid: int, user_promp
 @app.post("/pipelines")
 async def run_pipeline(
     request: Request,
-    background_tasks: BackgroundTasks,
     file: Optional[UploadFile] = File(None, description="File PDF o immagine (opzionale)"),
     user_prompt: Optional[str] = Form(None, description="Testo prompt utente (opzionale)"),
     body: Any = Depends(decode_body),
@@ -286,19 +382,19 @@ async def run_pipeline(
     try:
         if uploaded_file:
             suffix = os.path.splitext(uploaded_file.filename)[1] or ".pdf"
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                tmp.write(await uploaded_file.read())
-                tmp_path = tmp.name
-            recid, db_status = record_data(tmp_path, uploaded_file.filename, user_prompt)
+            tmp_path = await _save_upload(uploaded_file, suffix)
+            recid, db_status = await arecord_data(tmp_path, uploaded_file.filename, user_prompt, initial_status=2)
         else:
-            recid, db_status = record_data(None, None, user_prompt)
+            recid, db_status = await arecord_data(None, None, user_prompt, initial_status=2)
 
 
-        # Chiamata in background per parsing PDF
-        background_tasks.add_task(_process_pipeline_background, tmp_path, recid, user_prompt)
+        # Parsing PDF in un processo del pool, senza attendere il risultato
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(app.state.pool, _process_pipeline_background, tmp_path, recid, user_prompt)
+        future.add_done_callback(_log_task_error(recid))
         return {"recid": recid, "db_status": db_status}
 
     except Exception as e:
         if recid:
-            update_status(recid, 99)
+            await aupdate_status(recid, 99)
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -1,23 +1,61 @@
-from pdf_reader import extract_text_from_pdf
-from llm_agent import extract_data_from_text
+from typing import IO, Union
 
-def extract_data_from_file(file_path: str, model: str = "gpt-3.5-turbo", provider: str = "openrouter"):
+import extraction_cache
+from pdf_reader import extract_text_from_pdf, extract_text_from_pdf_bytes
+from llm_agent import (
+    extract_data_by_page, PROMPT_VERSION, LLM_MAX_TOKENS, LLM_MAX_INPUT_TOKENS, LLM_PAGE_SPLIT,
+)
+
+def extract_data_from_file(file_path: Union[str, IO[bytes]], model: str = "gpt-3.5-turbo", provider: str = "openrouter"):
     """
     Esegue OCR e parsing LLM su un file data.
 
-    :param file_path: Percorso del file PDF
+    Il risultato viene memorizzato nella cache di estrazione usando come
+    chiave l'hash del contenuto del file, il provider, il modello, la
+    versione del prompt e i limiti che cambiano la risposta dell'LLM
+    (LLM_MAX_TOKENS, LLM_MAX_INPUT_TOKENS, LLM_PAGE_SPLIT): un file
+    identico non viene rielaborato.
+
+    :param file_path: Percorso del file PDF oppure file binario già aperto
+                      (es. SpooledTemporaryFile)
     :param model: Nome del modello LLM
     :param provider: Provider (es. OpenAI)
     :return: dict con testo OCR, dati estratti, modello e provider
     """
     try:
-        text = extract_text_from_pdf(file_path)
-        data = extract_data_from_text(text, model_name=model, provider=provider)
-        return {
+        if isinstance(file_path, str):
+            with open(file_path, "rb") as f:
+                content = f.read()
+        else:
+            file_path.seek(0)
+            content = file_path.read()
+        key = extraction_cache.make_key(
+            provider, model, PROMPT_VERSION,
+            str(LLM_MAX_TOKENS), str(LLM_MAX_INPUT_TOKENS), str(LLM_PAGE_SPLIT),
+            extraction_cache.content_hash(content),
+        )
+
+        cached = extraction_cache.get(key)
+        if isinstance(cached, dict) and "text" in cached and "data" in cached:
+            return {
+                "text": cached["text"],
+                "data": cached["data"],
+                "model": model,
+                "provider": provider
+            }
+
+        if isinstance(file_path, str):
+            text = extract_text_from_pdf(file_path)
+        else:
+            text = extract_text_from_pdf_bytes(content)
+        data = extract_data_by_page(text, model_name=model, provider=provider)
+        result = {
             "text": text,
             "data": data,
             "model": model,
             "provider": provider
         }
+        extraction_cache.set(key, result)
+        return result
     except Exception as e:
         raise RuntimeError(f"Errore durante l'elaborazione del file data: {e}")
@@ -1,7 +1,19 @@
 # db_data.py
 import pyodbc
+import asyncio
+import json
+import logging
 import os
+import queue
+import time
+from contextlib import closing, contextmanager
 from datetime import datetime
+from typing import Dict
+
+try:
+    import zstandard as zstd
+except ImportError:  # compressione opzionale
+    zstd = None
 
 DB_CONN_STR = (
     #"DRIVER={ODBC Driver 17 for SQL Server};"
@@ -16,15 +28,111 @@ DB_CONN_STR = (
     "TrustServerCertificate=yes;"
 )
 
+# Pooling ODBC a livello di driver: va abilitato prima della prima connessione
+pyodbc.pooling = True
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+_pool: "queue.Queue[pyodbc.Connection]" = queue.Queue(maxsize=DB_POOL_SIZE)
+
+
+# Compressione facoltativa del contenuto salvato in Requests.Data.
+# Con DB_DATA_COMPRESSION=zstd i file oltre i 32 KB vengono compressi; i blob
+# compressi si riconoscono dal magic number zstd, quindi vecchie righe non
+# compresse restano leggibili con decode_data().
+DB_DATA_COMPRESSION = os.getenv("DB_DATA_COMPRESSION", "").lower()
+_ZSTD_MIN_SIZE = 32 * 1024
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+if DB_DATA_COMPRESSION == "zstd" and zstd is None:
+    logging.warning("DB_DATA_COMPRESSION=zstd ma il pacchetto zstandard non è installato: dati salvati non compressi")
+
+
+def _encode_data(content: bytes) -> bytes:
+    if DB_DATA_COMPRESSION == "zstd" and zstd is not None and len(content) >= _ZSTD_MIN_SIZE:
+        return zstd.ZstdCompressor(level=3).compress(content)
+    return content
+
+
+def decode_data(blob: bytes) -> bytes:
+    """Restituisce il contenuto originale di Requests.Data, decomprimendolo se necessario."""
+    if bytes(blob[:4]) == _ZSTD_MAGIC:
+        if zstd is None:
+            raise RuntimeError("Il dato è compresso con zstd ma il pacchetto zstandard non è installato")
+        return zstd.ZstdDecompressor().decompress(blob)
+    return blob
+
+
 def get_db_conn():
-    return pyodbc.connect(DB_CONN_STR)
+    # autocommit: ogni statement è già una transazione, niente commit() esplicito
+    return pyodbc.connect(DB_CONN_STR, autocommit=True)
+
+
+@contextmanager
+def conn_ctx():
+    """
+    Presta una connessione dal pool (creandola se il pool è vuoto) e la
+    restituisce al termine. In caso di errore la connessione viene chiusa
+    invece di essere rimessa nel pool, perché potrebbe non essere più valida.
+    """
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = get_db_conn()
+    try:
+        yield conn
+    except Exception:
+        conn.close()
+        raise
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Descrizioni della tabella Status (poche righe, cambiano di rado): caricate
+# una volta e risolte in memoria invece di fare la JOIN a ogni query
+_STATUS_MAP: Dict[int, str] = {}
+# Un codice assente provoca al massimo una ricarica ogni
+# STATUS_MAP_RELOAD_SECONDS, non una query per ogni richiesta
+STATUS_MAP_RELOAD_SECONDS = float(os.getenv("STATUS_MAP_RELOAD_SECONDS", "60"))
+_status_map_loaded_at = None
+
+
+def _load_status_map(cursor) -> None:
+    global _STATUS_MAP, _status_map_loaded_at
+    cursor.execute("SELECT Id, Description FROM Status")
+    # Nuovo dizionario sostituito con un solo assegnamento: gli altri thread
+    # vedono sempre la mappa vecchia o quella nuova, mai una mappa a metà
+    _STATUS_MAP = {row[0]: row[1] for row in cursor.fetchall()}
+    _status_map_loaded_at = time.monotonic()
+
+
+def load_status_map() -> Dict[int, str]:
+    """(Ri)carica la tabella Status in memoria; chiamata allo startup dell'app."""
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        _load_status_map(cursor)
+    return dict(_STATUS_MAP)
+
+
+def _status_description(cursor, status_code: int) -> str:
+    """
+    Descrizione dello stato dalla mappa in memoria. Se il codice non c'è
+    (mappa mai caricata o stato aggiunto dopo il caricamento) la mappa viene
+    ricaricata, al massimo una volta ogni STATUS_MAP_RELOAD_SECONDS.
+    """
+    status_map = _STATUS_MAP
+    if status_code not in status_map and (
+        _status_map_loaded_at is None
+        or time.monotonic() - _status_map_loaded_at >= STATUS_MAP_RELOAD_SECONDS
+    ):
+        _load_status_map(cursor)
+        status_map = _STATUS_MAP
+    return status_map.get(status_code) or "Non Trovato"
+
 
 def data(file_path: str, original_filename: str = None):
     with open(file_path, 'rb') as f:
         content = f.read()
 
-    conn = get_db_conn()
-    cursor = conn.cursor()
     sql = """
         INSERT INTO Requests (Filename, UploadDate, Data, Status)
         OUTPUT INSERTED.RecId
@@ -34,75 +142,72 @@ def data(file_path: str, original_filename: str = None):
     now = datetime.utcnow()
     status = 1
 
-    cursor.execute(sql, filename, now, pyodbc.Binary(content), status)
-    recid = cursor.fetchone()[0]
-    conn.commit()
-
-    cursor.execute("""
-        SELECT ISNULL(s.Description, 'Non Trovato')
-        FROM Requests r
-        LEFT JOIN Status s ON r.Status = s.Id
-        WHERE r.RecId = ?
-    """, recid)
-    status = cursor.fetchone()[0] if cursor.description else "Non Trovato"
-
-    cursor.close()
-    conn.close()
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute(sql, filename, now, pyodbc.Binary(_encode_data(content)), status)
+        recid = cursor.fetchone()[0]
+        status = _status_description(cursor, status)
 
     return recid, status
 
 def get_status_by_recid(recid: int):
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT isnull(s.Description,'Non Trovato') FROM Requests r left join Status s on r.Status=s.Id WHERE RecId = ?", recid)
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return row[0] if row else None
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute("SELECT Status FROM Requests WHERE RecId = ?", recid)
+        row = cursor.fetchone()
+        return _status_description(cursor, row[0]) if row else None
 
 def update_status(recid: int, status: int):
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE Requests SET Status = ? WHERE RecId = ?", status, recid)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute("UPDATE Requests SET Status = ? WHERE RecId = ?", status, recid)
+
+
+def _to_json(data: dict) -> str:
+    """Serializza i dati estratti in JSON compatto (leggibile con json.loads)."""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
 
 
 def save_extraction_results(recid: int, text: str, data: dict):
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE Requests SET ExtractedText = ?, ExtractedData = ? WHERE RecId = ?",
-        text, str(data), recid
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute(
+            "UPDATE Requests SET ExtractedText = ?, ExtractedData = ? WHERE RecId = ?",
+            text, _to_json(data), recid
+        )
+
+
+def save_and_complete(recid: int, text: str, data: dict, status: int = 4):
+    """
+    Salva testo e dati estratti e aggiorna lo stato con un solo UPDATE,
+    al posto di save_extraction_results + update_status.
+    """
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute(
+            "UPDATE Requests SET ExtractedText = ?, ExtractedData = ?, Status = ? WHERE RecId = ?",
+            text, _to_json(data), status, recid
+        )
 
 from typing import Optional
 
 def record_data(
     file_path: Optional[str],
     original_filename: Optional[str],
-    user_prompt: Optional[str]
+    user_prompt: Optional[str],
+    initial_status: int = 1
 ) -> tuple[int, str]:   # Cambia qui
     """
     Inserisce un nuovo record in db. Se 'file_path' è None,
     inserisce solo il prompt; il campo Data/Nome sarà null/empty.
+    'initial_status' (default 1 = “Uploaded / In Queue”) permette di inserire
+    direttamente lo stato 2 quando l'elaborazione parte subito, evitando
+    un UPDATE successivo.
     Restituisce (recid, status_description).
     """
-    conn = get_db_conn()
-    cursor = conn.cursor()
-
     now = datetime.utcnow()
-    status_code = 1  # STATUS = “Uploaded / In Queue”
+    status_code = initial_status
 
     filename = original_filename or ""
     binary_content = None
     if file_path:
         with open(file_path, "rb") as f:
-            binary_content = pyodbc.Binary(f.read())
+            binary_content = pyodbc.Binary(_encode_data(f.read()))
 
     sql = """
         INSERT INTO Requests
@@ -110,20 +215,28 @@ def record_data(
         OUTPUT INSERTED.RecId
         VALUES (?, ?, ?, ?, ?)
     """
-    cursor.execute(sql, filename, now, binary_content, status_code, user_prompt)
-    recid = cursor.fetchone()[0]
-    conn.commit()
-
-    cursor.execute("""
-        SELECT ISNULL(s.Description, 'Non Trovato')
-        FROM Requests r
-        LEFT JOIN Status s ON r.Status = s.Id
-        WHERE r.RecId = ?
-    """, recid)
-    status_desc = cursor.fetchone()[0]
-
-    cursor.close()
-    conn.close()
+    with conn_ctx() as conn, closing(conn.cursor()) as cursor:
+        cursor.execute(sql, filename, now, binary_content, status_code, user_prompt)
+        recid = cursor.fetchone()[0]
+        status_desc = _status_description(cursor, status_code)
+
     return recid, status_desc
 
 
+# Varianti async: eseguono le funzioni bloccanti (pyodbc) in un thread,
+# così le chiamate dagli endpoint async non fermano l'event loop.
+async def arecord_data(
+    file_path: Optional[str],
+    original_filename: Optional[str],
+    user_prompt: Optional[str],
+    initial_status: int = 1
+) -> tuple[int, str]:
+    return await asyncio.to_thread(record_data, file_path, original_filename, user_prompt, initial_status)
+
+
+async def aget_status_by_recid(recid: int):
+    return await asyncio.to_thread(get_status_by_recid, recid)
+
+
+async def aupdate_status(recid: int, status: int):
+    return await asyncio.to_thread(update_status, recid, status)
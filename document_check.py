@@ -1,17 +1,127 @@
 from fastapi import APIRouter
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
+import asyncio
+import random
+import time
 import httpx
 import os
 from dotenv import load_dotenv
 import logging
 
+from rate_limit import cleverp_limit
+
 router = APIRouter()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 CLEVERP_BASE_URL = os.getenv("CLEVERP_BASE_URL")
+# Numero massimo di richieste contemporanee verso Cleverp
+CLEVERP_CONCURRENCY = int(os.getenv("CLEVERP_CONCURRENCY", "10"))
+
+# Client HTTP condiviso (HTTP/2 + keep-alive), aperto/chiuso dagli eventi
+# startup/shutdown dell'app in api.py
+_client: Optional[httpx.AsyncClient] = None
+
+
+# Cache in memoria per clienti e articoli: cambiano raramente ma vengono
+# cercati per ogni documento
+CLEVERP_CACHE_TTL = float(os.getenv("CLEVERP_CACHE_TTL", "600"))
+CLEVERP_CACHE_SIZE = int(os.getenv("CLEVERP_CACHE_SIZE", "4096"))
+_MISS = object()
+
+
+class _TTLCache:
+    """Dizionario con scadenza delle voci; oltre ``maxsize`` rimuove le più vecchie."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[str, Tuple[float, Any]] = {}
+
+    def get(self, key: str) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISS
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return _MISS
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._data.pop(key, None)
+        while len(self._data) >= self.maxsize:
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+_clienti_cache = _TTLCache(CLEVERP_CACHE_TTL, CLEVERP_CACHE_SIZE)
+_articoli_cache = _TTLCache(CLEVERP_CACHE_TTL, CLEVERP_CACHE_SIZE)
+
+
+async def start_client() -> None:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _get_client() -> httpx.AsyncClient:
+    # Se il router è montato senza passare dallo startup, il client viene creato al primo uso
+    if _client is None:
+        await start_client()
+    return _client
+
+
+# Tentativi verso Cleverp in caso di errori transitori
+CLEVERP_MAX_ATTEMPTS = 3
+_RETRY_STATUS = frozenset({429, 502, 503, 504})
+# Attesa massima tra due tentativi, anche se Retry-After chiede di più:
+# la richiesta del chiamante resta aperta per tutta l'attesa
+_RETRY_MAX_DELAY = 8.0
+
+
+def _retry_delay(attempt: int, res: Optional[httpx.Response]) -> float:
+    """Attesa prima del tentativo successivo: Retry-After se presente, altrimenti backoff esponenziale con jitter."""
+    if res is not None:
+        retry_after = res.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), _RETRY_MAX_DELAY)
+    return min(_RETRY_MAX_DELAY, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+async def _post(url: str, payload: dict) -> httpx.Response:
+    """POST verso Cleverp con nuovi tentativi su errori di rete e risposte 429/502/503/504."""
+    client = await _get_client()
+    for attempt in range(CLEVERP_MAX_ATTEMPTS):
+        last = attempt == CLEVERP_MAX_ATTEMPTS - 1
+        try:
+            # Ogni tentativo consuma un token: i burst non superano CLEVERP_RATE_LIMIT
+            async with cleverp_limit:
+                res = await client.post(url, json=payload)
+        except httpx.TransportError:
+            if last:
+                raise
+            res = None
+        else:
+            if res.status_code not in _RETRY_STATUS or last:
+                res.raise_for_status()
+                return res
+        await asyncio.sleep(_retry_delay(attempt, res))
 
 class Riga(BaseModel):
     numero_riga: str
@@ -38,60 +148,113 @@ class DocumentoOutput(BaseModel):
     articoli_trovati: List[str]
     articoli_mancanti: List[str]
 
+def _sql_quote(value: str) -> str:
+    """Racchiude un valore tra apici per il filtro Where, raddoppiando gli apici interni."""
+    return "'" + value.replace("'", "''") + "'"
+
+
 async def cerca_cliente(description: str) -> Optional[str]:
+    cached = _clienti_cache.get(description)
+    if cached is not _MISS:
+        return cached
+
     url = f"{CLEVERP_BASE_URL}/Customer/GetManagedData"
     payload = {
         "Page": {"Index": 0, "Size": 1},
         "RequireTotalCount": False,
         "Select": ["Code"],
-        "Where": f"Description like '%{description}%'"
+        # Il valore viene quotato: un apice nella ragione sociale non rompe più il filtro
+        "Where": f"Description like {_sql_quote(f'%{description}%')}"
     }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            res = await client.post(url, json=payload)
-            res.raise_for_status()
-            data = res.json().get("data", [])
-            if data:
-                return data[0].get("Code")
-        except Exception as e:
-            logger.error(f"Errore cliente: {e}")
-    return None
-
-async def articoli_esistenti(codici: List[str]) -> List[str]:
-    url = f"{CLEVERP_BASE_URL}/Part/GetManagedData"
-    trovati = []
-
-    async with httpx.AsyncClient() as client:
-        for code in codici:
-            payload = {
-                "Page": {"Index": 0, "Size": 1},
-                "RequireTotalCount": False,
-                "Select": ["Code"],
-                "Where": f"Code = '{code}'"
-            }
+    try:
+        res = await _post(url, payload)
+        data = res.json().get("data", [])
+    except Exception as e:
+        logger.error(f"Errore cliente: {e}")
+        return None
+
+    # Si memorizza anche l'esito negativo, ma solo se la ricerca è andata a buon fine
+    codice = data[0].get("Code") if data else None
+    _clienti_cache.set(description, codice)
+    return codice
+
+async def _articoli_singoli(url: str, codici: List[str]) -> Set[str]:
+    """Verifica i codici uno per uno (in parallelo): usata se la ricerca con IN fallisce."""
+    sem = asyncio.Semaphore(CLEVERP_CONCURRENCY)
+
+    async def esiste(code: str) -> bool:
+        payload = {
+            "Page": {"Index": 0, "Size": 1},
+            "RequireTotalCount": False,
+            "Select": ["Code"],
+            "Where": f"Code = {_sql_quote(code)}"
+        }
+        async with sem:
             try:
-                res = await client.post(url, json=payload)
-                res.raise_for_status()
-                data = res.json().get("data", [])
-                if data:
-                    trovati.append(code)
+                res = await _post(url, payload)
+                return bool(res.json().get("data", []))
             except Exception as e:
                 logger.error(f"Errore articolo {code}: {e}")
-    return trovati
+                return False
+
+    # Le verifiche partono in parallelo, al massimo CLEVERP_CONCURRENCY alla volta
+    esiti = await asyncio.gather(*(esiste(code) for code in codici))
+    return {code for code, trovato in zip(codici, esiti) if trovato}
+
+
+async def articoli_esistenti(codici: Set[str]) -> Set[str]:
+    # Solo i codici non presenti in cache vengono chiesti a Cleverp
+    esiti = {code: _articoli_cache.get(code) for code in codici}
+    da_cercare = [code for code, esito in esiti.items() if esito is _MISS]
+
+    if da_cercare:
+        url = f"{CLEVERP_BASE_URL}/Part/GetManagedData"
+        # Una sola richiesta per tutti i codici
+        payload = {
+            "Page": {"Index": 0, "Size": len(da_cercare)},
+            "RequireTotalCount": False,
+            "Select": ["Code"],
+            "Where": f"Code in ({', '.join(_sql_quote(code) for code in da_cercare)})"
+        }
+
+        try:
+            res = await _post(url, payload)
+            data = res.json().get("data", [])
+        except Exception as e:
+            logger.warning(f"Ricerca articoli con IN non riuscita ({e}), verifica per singolo codice")
+            trovati = await _articoli_singoli(url, da_cercare)
+            for code in da_cercare:
+                esiti[code] = code in trovati
+        else:
+            # Il confronto lato DB non distingue maiuscole/minuscole
+            presenti = {str(row.get("Code", "")).strip().casefold() for row in data}
+            for code in da_cercare:
+                esiti[code] = code.strip().casefold() in presenti
+                _articoli_cache.set(code, esiti[code])
+
+    return {code for code, esito in esiti.items() if esito}
+
+@router.post("/cache/clear", summary="Svuota la cache Cleverp")
+async def svuota_cache():
+    """Invalida manualmente la cache di clienti e articoli."""
+    _clienti_cache.clear()
+    _articoli_cache.clear()
+    return {"status": "success"}
+
 
 @router.post("/verifica-documento", response_model=DocumentoOutput)
 async def verifica_documento(doc: DocumentoInput):
     codice_cliente = await cerca_cliente(doc.data.cliente)
     cliente_trovato = codice_cliente is not None
 
-    codici_articolo = list({r.codice_articolo for r in doc.data.righe})
+    codici_articolo = {r.codice_articolo for r in doc.data.righe}
     articoli_trovati = await articoli_esistenti(codici_articolo)
-    articoli_mancanti = list(set(codici_articolo) - set(articoli_trovati))
+    articoli_mancanti = codici_articolo - articoli_trovati
 
     return DocumentoOutput(
         cliente=cliente_trovato,
         codice_cliente=codice_cliente,
-        articoli_trovati=articoli_trovati,
-        articoli_mancanti=articoli_mancanti
+        articoli_trovati=sorted(articoli_trovati),
+        articoli_mancanti=sorted(articoli_mancanti)
     )
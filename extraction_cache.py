@@ -0,0 +1,135 @@
+"""
+extraction_cache.py
+===================
+
+Cache content-addressable per i risultati dell'estrazione (OCR + LLM).
+
+La chiave è ottenuta dall'hash SHA-256 dei byte del documento combinato
+con provider, modello e versione del prompt: se lo stesso PDF viene
+ricaricato con la stessa configurazione, il risultato viene letto dal
+disco senza ripetere OCR e chiamata al modello.
+
+Ogni voce è salvata come file JSON in ``EXTRACTION_CACHE_DIR`` (default
+``cache`` accanto a questo modulo).  La cache può essere disattivata con
+``EXTRACTION_CACHE=0``.
+
+La cache non cresce senza limite: le voci più vecchie di
+``EXTRACTION_CACHE_MAX_AGE_DAYS`` giorni (default 30) vengono ignorate e
+cancellate, e oltre ``EXTRACTION_CACHE_MAX_ENTRIES`` voci (default 10000)
+vengono eliminate le meno recenti.  La pulizia avviene durante le
+scritture, una volta ogni 100; ``0`` disattiva il limite
+corrispondente.  Cancellare la directory svuota la cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+CACHE_DIR = os.getenv(
+    "EXTRACTION_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+)
+CACHE_ENABLED = os.getenv("EXTRACTION_CACHE", "1") != "0"
+MAX_AGE_SECONDS = float(os.getenv("EXTRACTION_CACHE_MAX_AGE_DAYS", "30")) * 86400
+MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "10000"))
+# Scritture tra una pulizia e la successiva (la prima scrittura pulisce subito)
+_PRUNE_EVERY = 100
+_writes = 0
+
+
+def content_hash(content: bytes) -> str:
+    """Restituisce l'hash SHA-256 (esadecimale) dei byte indicati."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def make_key(*parts: str) -> str:
+    """Combina le parti della chiave in un unico hash stabile."""
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _expired(mtime: float, now: float) -> bool:
+    return MAX_AGE_SECONDS > 0 and now - mtime > MAX_AGE_SECONDS
+
+
+def prune() -> None:
+    """Elimina le voci scadute e, oltre ``MAX_ENTRIES``, quelle meno recenti."""
+    now = time.time()
+    entries = []
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for item in it:
+                # Anche i file temporanei rimasti da scritture interrotte
+                if not item.name.endswith((".json", ".tmp")):
+                    continue
+                try:
+                    mtime = item.stat().st_mtime
+                except OSError:
+                    continue
+                if _expired(mtime, now) or (item.name.endswith(".tmp") and now - mtime > 3600):
+                    _remove(item.path)
+                elif item.name.endswith(".json"):
+                    entries.append((mtime, item.path))
+    except OSError as e:
+        logging.warning("Impossibile pulire la cache %s: %s", CACHE_DIR, e)
+        return
+    if MAX_ENTRIES > 0 and len(entries) > MAX_ENTRIES:
+        entries.sort()
+        for _, path in entries[:len(entries) - MAX_ENTRIES]:
+            _remove(path)
+
+
+def get(key: str) -> Optional[Any]:
+    """Restituisce il valore salvato per ``key`` oppure ``None`` (anche se scaduto)."""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(key)
+    try:
+        if _expired(os.path.getmtime(path), time.time()):
+            _remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Voce di cache illeggibile %s: %s", key, e)
+        return None
+    return entry.get("value") if isinstance(entry, dict) else None
+
+
+def set(key: str, value: Any) -> None:
+    """Salva ``value`` per ``key`` con scrittura atomica; periodicamente pulisce la cache."""
+    global _writes
+    if not CACHE_ENABLED:
+        return
+    entry = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "value": value,
+    }
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, _entry_path(key))
+    except OSError as e:
+        logging.warning("Impossibile scrivere la cache %s: %s", key, e)
+        return
+    if _writes % _PRUNE_EVERY == 0:
+        prune()
+    _writes += 1
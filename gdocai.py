@@ -1,21 +1,32 @@
 import os
 import sys
-import json
+import base64
 import datetime
-from google.cloud import documentai_v1 as documentai
-from google.api_core.client_options import ClientOptions
+import gzip
+import io
+import queue
+import threading
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from dotenv import load_dotenv
 
-# Importa tkinter e filedialog per il dialogo di selezione file
-import tkinter as tk
-from tkinter import filedialog
-from tkinter import messagebox # Per mostrare messaggi di errore grafici
+import json_utils
+
+# tkinter e google.cloud.documentai vengono importati solo quando servono
+# (_use_gui() e _get_client()): da riga di comando lo script parte più
+# velocemente e funziona anche su server senza interfaccia grafica
 
 from rimappa_utils import (
     _get_entities, _get_pages, _get_entity_type, _get_entity_mention,
     _get_entity_properties, _get_property_type, _get_property_mention,
     _get_document_text, _get_tables, _get_header_rows, _get_body_rows,
-    _get_cells, _parse_number, _cell_text
+    _get_cells, _parse_number, _cell_text, _canon,
+    _pb_type, _pb_mention, _pb_cell_text
 )
 
 
@@ -45,38 +56,265 @@ LOCATION = os.getenv("DOCUMENT_AI_LOCATION", "eu")
 PROCESSOR_ID = os.getenv("DOCUMENT_AI_PROCESSOR_ID")
 
 # Nuove variabili per field_mask e process_options dal .env
-# Default: None (non applicato)
-FIELD_MASK = os.getenv("DOCUMENT_AI_FIELD_MASK", None)
+# Default: solo i campi letti da rimappa_json (testo, entità, tabelle), così la
+# risposta è molto più piccola; "*" per ricevere il documento completo
+# (necessario ad esempio per form_fields o token)
+FIELD_MASK = os.getenv("DOCUMENT_AI_FIELD_MASK") or "text,entities,pages.tables"
+if FIELD_MASK == "*":
+    FIELD_MASK = None
+# I campi modulo arrivano solo se la maschera li include (o se non c'è maschera)
+_MASK_FORM_FIELDS = FIELD_MASK is None or any(
+    path.strip() in ("pages", "pages.form_fields") for path in FIELD_MASK.split(",")
+)
 # Default: 0 significa processa tutte le pagine. Se 1, processa solo la prima pagina.
 PROCESS_FIRST_PAGE_ONLY = os.getenv("DOCUMENT_AI_PROCESS_FIRST_PAGE_ONLY", "0").lower() == "1"
 
+# Elaborazione batch (asincrona, via Google Cloud Storage) al posto di quella online.
+# Richiede un bucket GCS in cui caricare i PDF e ricevere i risultati.
+BATCH_MODE = os.getenv("DOCUMENT_AI_BATCH", "0") == "1"
+GCS_BUCKET = os.getenv("DOCUMENT_AI_GCS_BUCKET")
+BATCH_TIMEOUT = int(os.getenv("DOCUMENT_AI_BATCH_TIMEOUT", "1800"))  # secondi
+# Se impostato, in modalità online il PDF viene caricato su questo bucket e
+# Document AI lo legge da GCS invece di ricevere i bytes nella richiesta
+GCS_INPUT_BUCKET = os.getenv("DOCUMENT_AI_GCS_INPUT_BUCKET")
+# Se 1, il risultato completo viene salvato in binario protobuf (.pb) invece che in JSON
+SAVE_BINARY = os.getenv("DOCUMENT_AI_SAVE_BINARY", "0") == "1"
+# Il JSON completo viene scritto compresso (.json.gz); 0 per avere il .json in chiaro
+OUTPUT_GZIP = os.getenv("DOCUMENT_AI_OUTPUT_GZIP", "1") == "1"
+# Se 1, il JSON completo viene indentato per la lettura; di default è compatto
+PRETTY_JSON = os.getenv("DOCUMENT_AI_PRETTY_JSON", "0") == "1"
+# Se 0, viene salvato solo il JSON rimappato (.out.json) e non il risultato completo
+SAVE_RAW = os.getenv("DOCUMENT_AI_SAVE_RAW", "1") == "1"
+# Numero di PDF inviati in parallelo in modalità online (il client gRPC è thread-safe)
+PARALLEL_REQUESTS = int(os.getenv("DOCUMENT_AI_PARALLEL", "8"))
+# Compressione gzip sul canale gRPC (le risposte sono testo OCR, molto comprimibile)
+GRPC_GZIP = os.getenv("DOCUMENT_AI_GRPC_GZIP", "1") == "1"
+# Timeout complessivo (secondi) di una richiesta online, tentativi compresi
+REQUEST_TIMEOUT = float(os.getenv("DOCUMENT_AI_TIMEOUT", "300"))
+
+
+# Modulo tkinter.messagebox, impostato da _use_gui() quando si usa l'interfaccia grafica
+_messagebox = None
+
+# Messaggi per l'utente prodotti dai thread di elaborazione: tkinter va usato
+# solo dal thread principale, che li mostra svuotando questa coda
+_ui_queue: "queue.Queue[tuple]" = queue.Queue()
+
+
+def _use_gui():
+    """Importa tkinter (solo in modalità grafica) e restituisce (tk, filedialog, messagebox)."""
+    global _messagebox
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+    _messagebox = messagebox
+    return tk, filedialog, messagebox
+
+
+def _notify(kind: str, title: str, message: str):
+    """
+    Mostra un messagebox (showinfo/showerror); da un thread secondario lo accoda
+    per il thread principale. Senza interfaccia grafica stampa il messaggio.
+    """
+    if _messagebox is None:
+        print(f"{title}: {message}", file=sys.stderr if kind == "showerror" else sys.stdout)
+    elif threading.current_thread() is threading.main_thread():
+        getattr(_messagebox, kind)(title, message)
+    else:
+        _ui_queue.put((kind, title, message))
+
+
+def _report_error(title: str, message: str):
+    _notify("showerror", title, message)
+
 
 if not PROJECT_ID:
-    messagebox.showerror("Errore di Configurazione", "Variabile d'ambiente GOOGLE_CLOUD_PROJECT_ID non impostata nel file .env o nel tuo ambiente.")
+    _report_error("Errore di Configurazione", "Variabile d'ambiente GOOGLE_CLOUD_PROJECT_ID non impostata nel file .env o nel tuo ambiente.")
     sys.exit(1)
 if not PROCESSOR_ID:
-    messagebox.showerror("Errore di Configurazione", "Variabile d'ambiente DOCUMENT_AI_PROCESSOR_ID non impostata nel file .env o nel tuo ambiente. Dovrebbe essere l'ID numerico del tuo processore specifico.")
+    _report_error("Errore di Configurazione", "Variabile d'ambiente DOCUMENT_AI_PROCESSOR_ID non impostata nel file .env o nel tuo ambiente. Dovrebbe essere l'ID numerico del tuo processore specifico.")
     sys.exit(1)
 
 PROCESSOR_PATH = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+PDF_MIME_TYPE = "application/pdf"
+
+API_ENDPOINT = f"{LOCATION}-documentai.googleapis.com"
 
-client_options = ClientOptions(api_endpoint=f"{LOCATION}-documentai.googleapis.com")
-client = documentai.DocumentProcessorServiceClient(client_options=client_options)
+_client = None
+_client_lock = threading.Lock()
+_RETRY = None
+
+
+def _get_client():
+    """
+    Crea al primo utilizzo il client Document AI (un solo canale gRPC
+    persistente per tutto lo script) e la politica di nuovi tentativi.
+    """
+    global _client, _RETRY
+    with _client_lock:
+        if _client is not None:
+            return _client
+
+        import grpc
+        from google.api_core import exceptions as gexceptions, retry as gretry
+        from google.api_core.client_options import ClientOptions
+        from google.cloud import documentai_v1 as documentai
+        from google.cloud.documentai_v1.services.document_processor_service.transports import DocumentProcessorServiceGrpcTransport
+        from google.protobuf.internal import api_implementation
+
+        # Le risposte Document AI possono pesare diversi MB: con l'implementazione
+        # pure-Python di protobuf la deserializzazione è molto più lenta di upb/cpp
+        if api_implementation.Type() == "python":
+            print("Attenzione: protobuf usa l'implementazione pure-Python (lenta).")
+            print("Verifica che PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION non sia impostata a 'python' e aggiorna il pacchetto protobuf.")
+
+        # Creando il canale a mano vanno ripetute le opzioni che il trasporto
+        # imposta di suo (nessun limite di dimensione dei messaggi).
+        # I keepalive tengono viva la connessione HTTP/2 tra una richiesta e
+        # l'altra: niente nuovo handshake TCP+TLS dopo una pausa
+        channel = DocumentProcessorServiceGrpcTransport.create_channel(
+            API_ENDPOINT,
+            compression=grpc.Compression.Gzip if GRPC_GZIP else None,
+            options=[
+                ("grpc.max_send_message_length", -1),
+                ("grpc.max_receive_message_length", -1),
+                ("grpc.keepalive_time_ms", 30000),
+                ("grpc.keepalive_timeout_ms", 10000),
+                ("grpc.http2.max_pings_without_data", 0),
+            ],
+        )
+
+        # Nuovi tentativi espliciti solo per errori transitori, entro REQUEST_TIMEOUT
+        _RETRY = gretry.Retry(
+            initial=1.0,
+            maximum=10.0,
+            multiplier=2.0,
+            predicate=gretry.if_exception_type(gexceptions.ServiceUnavailable, gexceptions.DeadlineExceeded),
+            timeout=REQUEST_TIMEOUT,
+        )
+        _client = documentai.DocumentProcessorServiceClient(
+            client_options=ClientOptions(api_endpoint=API_ENDPOINT),
+            transport=DocumentProcessorServiceGrpcTransport(host=API_ENDPOINT, channel=channel),
+        )
+        return _client
+
+
+@lru_cache(maxsize=None)
+def _process_options():
+    """
+    Opzioni di processamento derivate dal .env, costruite una sola volta
+    (il messaggio proto viene riusato per tutte le richieste).
+    """
+    if not PROCESS_FIRST_PAGE_ONLY:
+        return None
+    from google.cloud import documentai_v1 as documentai
+    return documentai.ProcessOptions(
+        individual_page_selector=documentai.ProcessOptions.IndividualPageSelector(
+            pages=[1] # Processa solo la pagina 1 (indice 0 è la prima pagina)
+        )
+    )
+
+
+def _esegui_in_background(root, fn, items, max_workers: int = 1):
+    """
+    Esegue fn(item) per ogni elemento di items in un pool di thread, lasciando
+    libero il loop Tk che intanto mostra i messaggi accodati.
+    Ritorna quando tutte le elaborazioni sono finite.
+    Senza interfaccia grafica (root None) attende semplicemente i thread.
+    """
+    if root is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fn, item) for item in items]
+        for future in futures:
+            if future.exception() is not None:
+                _report_error("Errore", f"Errore imprevisto durante l'elaborazione: {future.exception()}")
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(fn, item) for item in items]
+    executor.shutdown(wait=False)
+
+    def pump():
+        while True:
+            try:
+                kind, title, message = _ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            getattr(_messagebox, kind)(title, message)
+        if all(future.done() for future in futures):
+            for future in futures:
+                if future.exception() is not None:
+                    _messagebox.showerror("Errore", f"Errore imprevisto durante l'elaborazione: {future.exception()}")
+            root.quit()
+        else:
+            root.after(100, pump)
+
+    root.after(100, pump)
+    root.mainloop()
 
 
 # DEFINIZIONA FUNZIONI
-def extract_text(layout, document):
-    """Estrae il testo da un layout senza usare HasField."""
-    if not layout.text_anchor.text_segments:
-        return ""
+def _iter_document_fields(document_proto):
+    """
+    Restituisce le coppie (campo, valore) del Document già convertite in tipi JSON.
+    I campi ripetuti (pages, entities, ...) sono generatori che convertono un
+    elemento alla volta, così il documento non viene mai materializzato per intero.
+    Gli enum sono scritti come interi (vedi _enum_schema per la decodifica).
+    """
+    from google.protobuf.json_format import MessageToDict
+
+    # I campi con valore di default sono già omessi da MessageToDict
+    to_dict = partial(MessageToDict, preserving_proto_field_name=True, use_integers_for_enums=True)
+
+    for field, value in document_proto._pb.ListFields():
+        # protobuf >= 5 espone is_repeated; le versioni precedenti solo label
+        repeated = getattr(field, "is_repeated", None)
+        if repeated is None:
+            repeated = field.label == field.LABEL_REPEATED
+        if field.message_type is not None:
+            if repeated:
+                yield field.name, (to_dict(item) for item in value)
+            else:
+                yield field.name, to_dict(value)
+        elif field.type == field.TYPE_BYTES:
+            yield field.name, base64.b64encode(value).decode("ascii")
+        else:
+            yield field.name, value
+
+
+@lru_cache(maxsize=None)
+def _enum_schema() -> dict:
+    """
+    Mappa {nome completo dell'enum: {valore intero: nome}} per tutti gli enum
+    raggiungibili dal Document, calcolata una volta dal DESCRIPTOR.
+    Viene salvata accanto al JSON (_schema.json) per decodificare gli interi.
+    """
+    from google.cloud import documentai_v1 as documentai
+
+    schema = {}
+    visitati = set()
 
-    text = ""
-    for segment in layout.text_anchor.text_segments:
-        start_index = getattr(segment, "start_index", 0)
-        end_index = segment.end_index
-        text += document.text[start_index:end_index]
-    return text.strip()
+    def visita(descriptor):
+        if descriptor.full_name in visitati:
+            return
+        visitati.add(descriptor.full_name)
+        for field in descriptor.fields:
+            if field.enum_type is not None:
+                enum = field.enum_type
+                schema[enum.full_name] = {str(v.number): v.name for v in enum.values}
+            if field.message_type is not None:
+                visita(field.message_type)
 
+    visita(documentai.Document.pb().DESCRIPTOR)
+    return schema
+
+
+# Campi di testata: sottostringa del tipo di entità -> chiave di output.
+# L'ordine conta: vale la prima corrispondenza, come nella vecchia cascata if/elif
+_ENTITY_MAP = {
+    "fornitore": "fornitore",
+    "numero": "numero_documento",
+    "data": "data_documento",
+}
 
 
 def rimappa_json(document_proto):
@@ -91,95 +329,143 @@ def rimappa_json(document_proto):
         "riga": []
     }
 
-    # Testo completo usato per estrarre il contenuto delle celle
-    full_text = _get_document_text(document_proto)
+    # Con un Document proto-plus si lavora sul messaggio protobuf sottostante:
+    # l'accesso ai campi di _pb (implementazione C) evita di creare un wrapper
+    # proto-plus per ogni entità, pagina, cella e segmento visitati.
+    # Gli accessori sono scelti una volta per documento: per il protobuf
+    # attrgetter e _pb_* leggono i campi direttamente, senza il controllo
+    # isinstance e i ripieghi sui nomi camelCase degli helper generici, che
+    # restano per i dizionari (JSON)
+    document_proto = getattr(document_proto, "_pb", document_proto)
+    if isinstance(document_proto, dict):
+        get_entities, get_pages, get_tables = _get_entities, _get_pages, _get_tables
+        get_header_rows, get_body_rows = _get_header_rows, _get_body_rows
+        get_cells, get_properties = _get_cells, _get_entity_properties
+        entity_type, entity_mention = _get_entity_type, _get_entity_mention
+        property_type, property_mention = _get_property_type, _get_property_mention
+        cell_text = _cell_text
+        # Testo completo usato per estrarre il contenuto delle celle
+        full_text = _get_document_text(document_proto)
+    else:
+        get_entities, get_pages, get_tables = attrgetter("entities"), attrgetter("pages"), attrgetter("tables")
+        get_header_rows, get_body_rows = attrgetter("header_rows"), attrgetter("body_rows")
+        get_cells, get_properties = attrgetter("cells"), attrgetter("properties")
+        entity_type = property_type = _pb_type
+        entity_mention = property_mention = _pb_mention
+        cell_text = _pb_cell_text
+        full_text = document_proto.text
+
+    def col(cells, idx):
+        """Testo della cella alla colonna idx, None se la colonna manca."""
+        if idx is None or idx >= len(cells):
+            return None
+        return cell_text(cells[idx], full_text)
+
+    # 1) Campi principali dal blocco entità; le entità "riga" vengono messe
+    #    da parte per il punto 3, così le entità si scorrono una volta sola
+    righe_entities = []
+    for ent in get_entities(document_proto):
+        etype = entity_type(ent)
+        if etype == "riga":
+            righe_entities.append(ent)
+            continue
+        for key, out_key in _ENTITY_MAP.items():
+            if key in etype:
+                risultato[out_key] = entity_mention(ent)
+                break
 
-    # 1) Campi principali dal blocco entità
-    for ent in _get_entities(document_proto):
-        etype = _get_entity_type(ent).lower()
-        evalue = _get_entity_mention(ent)
-        if "fornitore" in etype:
-            risultato["fornitore"] = evalue
-        elif "numero" in etype:
-            risultato["numero_documento"] = evalue
-        elif "data" in etype:
-            risultato["data_documento"] = evalue
+    # Le tabelle servono solo a trovare i prezzi delle entità "riga": senza
+    # righe (es. processori solo OCR) pagine e tabelle non vanno nemmeno lette
+    if not righe_entities:
+        return risultato
 
     # 2) Costruisci l'elenco di righe di tabella con codice, quantità e prezzo unitario
+    #    (documenti senza tabelle: nessuna riga, si passa direttamente alle entità)
     prod_rows = []
-    for page in _get_pages(document_proto):
-        for table in _get_tables(page):
-            header_rows = _get_header_rows(table)
-            if not header_rows:
-                continue
-            first_header_row = header_rows[0]
-            # usa _get_cells() per ottenere le celle sia dai protobuf sia dai dizionari
-            header_cells = _get_cells(first_header_row)
-            header = [ _cell_text(cell, full_text).lower() for cell in header_cells ]
-            
-            if "codice articolo" not in header:
-                continue
-            idx_cod = header.index("codice articolo")
-            idx_quant = header.index("quantita'") if "quantita'" in header else None
-            idx_price_unit = header.index("prezzo unitario") if "prezzo unitario" in header else None
-            idx_price_tot  = header.index("prezzo totale")  if "prezzo totale"  in header else None
-            if idx_quant is None:
+    tables = [table for page in get_pages(document_proto) for table in get_tables(page)]
+    for table in tables:
+        header_rows = get_header_rows(table)
+        if not header_rows:
+            continue
+        first_header_row = header_rows[0]
+        header_cells = get_cells(first_header_row)
+        # Indice colonna per nome canonico, calcolato una volta per tabella
+        # (a parità di nome vale la prima colonna, come con list.index);
+        # "Quantità", "quantita'" e "quantita" indicano la stessa colonna
+        col_idx = {}
+        for i, cell in enumerate(header_cells):
+            col_idx.setdefault(_canon(cell_text(cell, full_text)), i)
+
+        idx_cod = col_idx.get("codice articolo")
+        idx_quant = col_idx.get("quantita")
+        if idx_cod is None or idx_quant is None:
+            continue
+        idx_price_unit = col_idx.get("prezzo unitario")
+        idx_price_tot = col_idx.get("prezzo totale")
+
+        for body_row in get_body_rows(table):
+            cells = get_cells(body_row)
+            # Limiti verificati una volta per riga: codice e quantità si leggono
+            # per posizione, solo le colonne di prezzo (facoltative) passano da col()
+            if idx_cod >= len(cells) or idx_quant >= len(cells):
                 continue
-
-            for body_row in _get_body_rows(table):
-                cells = _get_cells(body_row)
-                if idx_cod >= len(cells) or idx_quant >= len(cells):
-                    continue
-                code = _cell_text(cells[idx_cod], full_text)
-                quant_str = _cell_text(cells[idx_quant], full_text)
-                qty = _parse_number(quant_str)
-                if code and qty is not None:
-                    price_unit = None
-                    price_tot  = None
-                    if idx_price_unit is not None and idx_price_unit < len(cells):
-                        price_unit = _parse_number(_cell_text(cells[idx_price_unit], full_text))
-                    if idx_price_tot is not None and idx_price_tot < len(cells):
-                        price_tot  = _parse_number(_cell_text(cells[idx_price_tot], full_text))
-                    if price_unit is None and price_tot is not None and qty != 0:
-                        price_unit = price_tot / qty
-                    prod_rows.append({"codice_articolo": code,
-                                      "quantita": qty,
-                                      "prezzo": price_unit})
+            code = cell_text(cells[idx_cod], full_text)
+            qty = _parse_number(cell_text(cells[idx_quant], full_text))
+            if code and qty is not None:
+                price_unit = _parse_number(col(cells, idx_price_unit))
+                price_tot  = _parse_number(col(cells, idx_price_tot))
+                if price_unit is None and price_tot is not None and qty != 0:
+                    price_unit = price_tot / qty
+                prod_rows.append({"codice_articolo": code,
+                                  "quantita": qty,
+                                  "prezzo": price_unit})
 
     # mappa codice → primo prezzo disponibile
     price_map = {}
     for row in prod_rows:
         if row["prezzo"] is not None and row["codice_articolo"] not in price_map:
             price_map[row["codice_articolo"]] = row["prezzo"]
-    prod_remaining = prod_rows.copy()
+
+    # Indici delle righe di tabella per codice e per (codice, quantità), in ordine
+    # di apparizione: ogni ricerca è O(1) invece di una scansione della lista.
+    # Una riga abbinata finisce in "usate" e viene scartata dall'altro indice
+    # alla prima lettura successiva.
+    by_code = defaultdict(deque)
+    by_code_qty = defaultdict(deque)
+    for i, row in enumerate(prod_rows):
+        by_code[row["codice_articolo"]].append(i)
+        by_code_qty[(row["codice_articolo"], round(row["quantita"], 6))].append(i)
+    usate = set()
+
+    def prima_libera(coda):
+        while coda and coda[0] in usate:
+            coda.popleft()
+        return coda.popleft() if coda else None
 
     def match_price(code, qty):
         if not code:
             return None
+        i = None
         if qty is not None:
-            for i, row in enumerate(prod_remaining):
-                if row["codice_articolo"] == code and abs(row["quantita"] - qty) < 1e-6:
-                    p = row["prezzo"]
-                    prod_remaining.pop(i)
-                    return p
-        for i, row in enumerate(prod_remaining):
-            if row["codice_articolo"] == code:
-                p = row["prezzo"]
-                prod_remaining.pop(i)
-                return p
-        return None
+            i = prima_libera(by_code_qty.get((code, round(qty, 6))))
+        if i is None:
+            i = prima_libera(by_code.get(code))
+        if i is None:
+            return None
+        usate.add(i)
+        return prod_rows[i]["prezzo"]
 
     # 3) crea la lista delle righe dalle entità di tipo "riga"
-    for ent in _get_entities(document_proto):
-        if _get_entity_type(ent).lower() != "riga":
-            continue
+    for ent in righe_entities:
+        # Nomi delle proprietà in forma canonica: "quantità" e "quantita" coincidono
         props = {}
-        for prop in _get_entity_properties(ent):
-            props[_get_property_type(prop)] = _get_property_mention(prop)
+        for prop in get_properties(ent):
+            props[_canon(property_type(prop))] = property_mention(prop)
         code = props.get("codice_articolo", "")
-        qty_str = props.get("quantita") or props.get("quantità")
+        qty_str = props.get("quantita")
         qty = _parse_number(qty_str) if qty_str else None
-        price = match_price(code, qty)
+        # Senza righe di tabella non c'è nessun prezzo da abbinare
+        price = match_price(code, qty) if prod_rows else None
         if price is None and code in price_map:
             price = price_map[code]
         if price is None:
@@ -197,15 +483,172 @@ def rimappa_json(document_proto):
 
 
 
-def process_document(file_path: str):
+@contextmanager
+def _scrittura_atomica(path: Path):
     """
-    Invia un documento PDF a Google Document AI e stampa il risultato JSON completo.
-    Utilizza field_mask e process_options se configurati.
+    Restituisce un percorso temporaneo (<nome>.tmp) in cui scrivere; a scrittura
+    completata viene rinominato in path, in caso di errore rimosso.
+    Un'interruzione non lascia mai file troncati con il nome definitivo.
     """
-    if not os.path.exists(file_path):
-        messagebox.showerror("Errore File", f"Errore: Il file '{file_path}' non esiste.")
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _salva_risultati(file_path: str, document_proto, suffix: str = "") -> str:
+    """
+    Salva accanto al PDF il risultato completo di Document AI (JSON, oppure
+    .pb con DOCUMENT_AI_SAVE_BINARY=1; nessuno con DOCUMENT_AI_SAVE_RAW=0)
+    e il JSON rimappato (.out.json).
+    Restituisce il percorso del file con il risultato completo, oppure
+    quello del JSON rimappato se il risultato completo non viene salvato.
+    """
+    # Nome base calcolato una volta: i due file condividono lo stesso timestamp
+    source = Path(file_path)
+    output_base = f"{source.stem}_{datetime.datetime.now():%Y%m%d_%H%M%S}{suffix}"
+    output_path = None
+
+    if SAVE_RAW and SAVE_BINARY:
+        # Serializzazione binaria nativa: molto più veloce e compatta del JSON;
+        # si ricarica con carica_documento_da_pb()
+        output_path = source.with_name(f"{output_base}.pb")
+        with _scrittura_atomica(output_path) as tmp_path, open(tmp_path, 'wb') as pb_file:
+            pb_file.write(document_proto._pb.SerializeToString())
+    elif SAVE_RAW:
+        # Salva il JSON su file invece di stamparlo
+        output_path = source.with_name(f"{output_base}.json.gz" if OUTPUT_GZIP else f"{output_base}.json")
+        with _scrittura_atomica(output_path) as tmp_path:
+            if OUTPUT_GZIP:
+                # Compresso direttamente in scrittura: il testo OCR si riduce di 5-10 volte
+                # e il livello 3 è molto più veloce del 9 con quasi lo stesso risultato
+                json_file = io.BufferedWriter(gzip.open(tmp_path, 'wb', compresslevel=3), buffer_size=1 << 20)
+            else:
+                json_file = open(tmp_path, 'wb', buffering=1 << 20)
+
+            # Scrittura in streaming: un campo (e una pagina/entità) alla volta,
+            # convertiti con MessageToDict sul protobuf sottostante (_pb)
+            with json_file:
+                json_utils.dump_stream(_iter_document_fields(document_proto), json_file, indent=PRETTY_JSON)
+
+        # Gli enum sono salvati come interi: lo schema permette di risalire ai nomi
+        schema_path = source.with_name(f"{output_base}_schema.json")
+        with _scrittura_atomica(schema_path) as tmp_path, open(tmp_path, 'wb') as schema_file:
+            json_utils.dump(_enum_schema(), schema_file, indent=True)
+
+    # Trasformazione
+    dati_trasformati = rimappa_json(document_proto)
+
+    out2_path = source.with_name(f"{output_base}.out.json")
+
+    with _scrittura_atomica(out2_path) as tmp_path, open(tmp_path, "wb") as f:
+        json_utils.dump(dati_trasformati, f, indent=True)
+
+    output_path = output_path or out2_path
+    print(f"\n--- Risultato salvato in: {output_path} ---")
+    return str(output_path)
+
+
+def _percorso_locale(file_path: str) -> str:
+    """Percorso accanto a cui salvare i risultati: per un PDF su GCS (gs://) la cartella corrente."""
+    if file_path.startswith("gs://"):
+        return os.path.join(os.getcwd(), file_path.rsplit("/", 1)[-1])
+    return file_path
+
+
+def process_documents_batch(file_paths: list[str], max_wait_seconds: float = BATCH_TIMEOUT):
+    """
+    Elabora più PDF con l'API batch di Document AI: i file locali vengono
+    caricati su GCS_BUCKET (i percorsi gs:// sono usati direttamente),
+    elaborati in parallelo lato Google (operazione a lunga durata) e i
+    risultati scaricati e salvati come in process_document.
+    L'attesa dell'operazione è limitata a max_wait_seconds.
+    """
+    from google.cloud import storage  # usato solo in modalità batch
+    from google.cloud import documentai_v1 as documentai
+
+    if not GCS_BUCKET:
+        _notify("showerror", "Errore di Configurazione", "DOCUMENT_AI_BATCH=1 richiede la variabile DOCUMENT_AI_GCS_BUCKET.")
         return
 
+    print("\n--- Inizio Processamento Batch ---")
+    print(f"Documenti: {len(file_paths)}")
+    print(f"Processore: {PROCESSOR_PATH}")
+
+    bucket = storage.Client().bucket(GCS_BUCKET)
+    prefix = f"gdocai/{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    # gs://bucket/prefix/input/<n>_<nome> -> percorso locale
+    sorgenti = {}
+    try:
+        for i, file_path in enumerate(file_paths):
+            if file_path.startswith("gs://"):
+                sorgenti[file_path] = file_path
+                continue
+            blob = bucket.blob(f"{prefix}/input/{i}_{os.path.basename(file_path)}")
+            blob.upload_from_filename(file_path, content_type=PDF_MIME_TYPE)
+            sorgenti[f"gs://{GCS_BUCKET}/{blob.name}"] = file_path
+
+        request = documentai.BatchProcessRequest(
+            name=PROCESSOR_PATH,
+            input_documents=documentai.BatchDocumentsInputConfig(
+                gcs_documents=documentai.GcsDocuments(documents=[
+                    documentai.GcsDocument(gcs_uri=uri, mime_type=PDF_MIME_TYPE) for uri in sorgenti
+                ])
+            ),
+            document_output_config=documentai.DocumentOutputConfig(
+                gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(
+                    gcs_uri=f"gs://{GCS_BUCKET}/{prefix}/output/",
+                    field_mask=FIELD_MASK,
+                )
+            ),
+            process_options=_process_options(),
+        )
+
+        print("Invio richiesta batch a Google Document AI...")
+        operation = _get_client().batch_process_documents(request=request)
+        operation.result(timeout=max_wait_seconds)
+        metadata = documentai.BatchProcessMetadata(operation.metadata)
+
+        salvati = []
+        for status in metadata.individual_process_statuses:
+            file_path = sorgenti.get(status.input_gcs_source)
+            if file_path is None or not status.output_gcs_destination:
+                print(f"Nessun output per {status.input_gcs_source}: {status.status.message}")
+                continue
+            # L'output di un documento può essere diviso in più shard JSON
+            out_prefix = status.output_gcs_destination.removeprefix(f"gs://{GCS_BUCKET}/")
+            shards = [b for b in bucket.list_blobs(prefix=out_prefix) if b.name.endswith(".json")]
+            for n, shard in enumerate(sorted(shards, key=lambda b: b.name)):
+                document_proto = documentai.Document.from_json(shard.download_as_bytes(), ignore_unknown_fields=True)
+                suffix = f"_shard{n}" if len(shards) > 1 else ""
+                salvati.append(_salva_risultati(_percorso_locale(file_path), document_proto, suffix))
+
+        _notify("showinfo", "Processamento Completato", f"Documenti elaborati: {len(salvati)}/{len(file_paths)}")
+
+    except Exception as e:
+        error_message = f"Si è verificato un errore durante il processamento batch Document AI: {e}"
+        print(f"\n{error_message}")
+        _notify("showerror", "Errore Document AI", error_message)
+
+    finally:
+        # I file su GCS servono solo per l'elaborazione
+        try:
+            for blob in bucket.list_blobs(prefix=prefix):
+                blob.delete()
+        except Exception as e:
+            print(f"Attenzione: impossibile rimuovere i file temporanei gs://{GCS_BUCKET}/{prefix}: {e}")
+
+    print("\n--- Fine Processamento Batch ---")
+
+
+def process_document(file_path: str):
+    """
+    Invia un documento PDF (locale o gs://) a Google Document AI e stampa il risultato JSON completo.
+    Utilizza field_mask e process_options se configurati.
+    """
     print(f"\n--- Inizio Processamento ---")
     print(f"Documento: {file_path}")
     print(f"Processore: {PROCESSOR_PATH}")
@@ -214,101 +657,65 @@ def process_document(file_path: str):
     if PROCESS_FIRST_PAGE_ONLY:
         print("Processamento solo della prima pagina.")
 
+    from google.cloud import documentai_v1 as documentai
+
+    gcs_blob = None
     try:
-        with open(file_path, "rb") as document_file:
-            document_content = document_file.read()
-    except IOError as e:
-        messagebox.showerror("Errore Lettura File", f"Errore nella lettura del file '{file_path}': {e}")
+        if file_path.startswith("gs://"):
+            # PDF già su GCS: Document AI lo legge direttamente
+            document_source = {"gcs_document": documentai.GcsDocument(gcs_uri=file_path, mime_type=PDF_MIME_TYPE)}
+        elif GCS_INPUT_BUCKET:
+            # Upload (resumable per i file grandi) su GCS: il PDF non passa dalla
+            # memoria del processo né viaggia dentro la richiesta
+            from google.cloud import storage
+            gcs_blob = storage.Client().bucket(GCS_INPUT_BUCKET).blob(f"gdocai/input/{uuid.uuid4().hex}_{Path(file_path).name}")
+            gcs_blob.upload_from_filename(file_path, content_type=PDF_MIME_TYPE, timeout=REQUEST_TIMEOUT)
+            document_source = {"gcs_document": documentai.GcsDocument(
+                gcs_uri=f"gs://{GCS_INPUT_BUCKET}/{gcs_blob.name}", mime_type=PDF_MIME_TYPE
+            )}
+        else:
+            # RawDocument richiede comunque i bytes: lettura in un colpo con buffer da 1 MiB
+            with open(file_path, "rb", buffering=1 << 20) as document_file:
+                document_content = document_file.read()
+            document_source = {"raw_document": documentai.RawDocument(content=document_content, mime_type=PDF_MIME_TYPE)}
+    except FileNotFoundError:
+        _notify("showerror", "Errore File", f"Errore: Il file '{file_path}' non esiste.")
+        return
+    except Exception as e:
+        _notify("showerror", "Errore Lettura File", f"Errore nella lettura del file '{file_path}': {e}")
         return
-
-    raw_document = documentai.RawDocument(content=document_content, mime_type="application/pdf")
-
-    # --- Configurazione delle opzioni di processamento (process_options) ---
-    process_options = None
-    if PROCESS_FIRST_PAGE_ONLY:
-        process_options = documentai.ProcessOptions(
-            individual_page_selector=documentai.ProcessOptions.IndividualPageSelector(
-                pages=[1] # Processa solo la pagina 1 (indice 0 è la prima pagina)
-            )
-        )
 
     # Crea la richiesta di processamento, includendo field_mask e process_options se definiti
     request = documentai.ProcessRequest(
         name=PROCESSOR_PATH,
-        raw_document=raw_document,
+        **document_source, # raw_document oppure gcs_document
         field_mask=FIELD_MASK, # Passa il field_mask se impostato
-        process_options=process_options, # Passa le opzioni di processamento se impostate
+        process_options=_process_options(), # Opzioni di processamento, se impostate
     )
 
     try:
         print("Invio richiesta a Google Document AI...")
-        result = client.process_document(request=request)
+        client = _get_client()
+        result = client.process_document(request=request, retry=_RETRY, timeout=REQUEST_TIMEOUT)
         document_proto = result.document
 
-#KDFGKJDKG
-        # Salva il JSON su file invece di stamparlo
-        json_output = documentai.Document.to_json(document_proto)
-        output_filename = f"{os.path.splitext(os.path.basename(file_path))[0]}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        output_path = os.path.join(os.path.dirname(file_path), output_filename)
-        
-        with open(output_path, 'w', encoding='utf-8') as json_file:
-            json.dump(json.loads(json_output), json_file, indent=2, ensure_ascii=False)
-
-        # DFJDFJHDH fdgdfgdfgdfg
-        # FBechelli in progress
-        # Trasformazione
-        dati_trasformati = rimappa_json(document_proto)
-#
-#       # # Salvataggio in un nuovo file
-        #
-        out2_filename = f"{os.path.splitext(os.path.basename(file_path))[0]}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.out.json"
-        out2_path = os.path.join(os.path.dirname(file_path), out2_filename)
-#
-        with open(out2_path, "w", encoding="utf-8") as f:
-            json.dump(dati_trasformati, f, ensure_ascii=False, indent=2)
-        
-        print(f"\n--- JSON salvato in: {output_path} ---")
-
-
-        # FBechelli - Per print a terminale
-        #print("\n--- Testo estratto (OCR) ---")
-        #if document_proto.text:
-        #    print(document_proto.text)
-        #else:
-        #    print("Nessun testo grezzo estratto. Il processore potrebbe non essere un OCR o il documento è vuoto.")
-#
-        #if document_proto.entities:
-        #    print("\n--- Entità estratte ---")
-        #    for entity in document_proto.entities:
-        #        print(f" '{entity}'")
-        #        if entity.properties:
-        #            print("    Proprietà:")
-        #            for prop in entity.properties:
-        #                print(f"      - {prop}")
-        #elif document_proto.pages:
-        #    for i, page in enumerate(document_proto.pages):
-        #        if page.form_fields:
-        #            print(f"\n--- Campi modulo estratti (Pagina {i+1}) ---")
-        #            for field in page.form_fields:
-        #                field_name = field.field_name.text if field.field_name else "N/A"
-        #                field_value = field.field_value.text if field.field_value else "N/A"
-        #                print(f"  Campo: '{field_name}', Valore: '{field_value}', Confidence: {field.field_value.confidence:.2f}")
-#
-        #        if page.tables:
-        #            print(f"\n--- Tabelle estratte (Pagina {i+1}) ---")
-        #            for j, table in enumerate(page.tables):
-        #                print(f"  Tabella {j+1}:")
-        #                for row_index, row in enumerate(table.header_rows):
-        #                    header_values = [cell.text for cell in row.cells]
-        #                    print(f"    Header {row_index+1}: {header_values}")
-        #                for row_index, row in enumerate(table.body_rows):
-        #                    row_values = [cell.text for cell in row.cells]
-        #                    print(f"    Riga {row_index+1}: {row_values}")
-#
-        if not document_proto.entities and not any(page.form_fields or page.tables for page in document_proto.pages):
+        output_path = _salva_risultati(_percorso_locale(file_path), document_proto)
+
+        # Un solo passaggio sulle pagine (protobuf grezzo, senza wrapper proto-plus),
+        # interrotto appena sono stati trovati sia tabelle sia campi modulo; con
+        # una maschera senza form_fields si cercano solo le tabelle
+        has_tables = has_ff = False
+        for page in document_proto._pb.pages:
+            has_tables = has_tables or bool(page.tables)
+            if _MASK_FORM_FIELDS:
+                has_ff = has_ff or bool(page.form_fields)
+            if has_tables and (has_ff or not _MASK_FORM_FIELDS):
+                break
+
+        if not document_proto.entities and not (has_tables or has_ff):
             print("\nNessuna entità, campo modulo o tabella estratta (il processore potrebbe essere solo OCR o i dati non sono stati riconosciuti).")
         
-        messagebox.showinfo("Processamento Completato", f"Il documento è stato processato con successo! JSON salvato in: {output_path}")
+        _notify("showinfo", "Processamento Completato", f"Il documento è stato processato con successo! Risultato salvato in: {output_path}")
 
     except Exception as e:
         error_message = f"Si è verificato un errore durante il processamento Document AI: {e}\n\n" \
@@ -317,58 +724,109 @@ def process_document(file_path: str):
                         "  - Processore non trovato/non valido: Controlla gli ID e la regione nel tuo .env.\n" \
                         "  - Errore di rete/server Google Cloud: Riprova più tardi."
         print(f"\n{error_message}")
-        messagebox.showerror("Errore Document AI", error_message)
+        _notify("showerror", "Errore Document AI", error_message)
+
+    finally:
+        # Il PDF su GCS serve solo per questa richiesta
+        if gcs_blob is not None:
+            try:
+                gcs_blob.delete()
+            except Exception as e:
+                print(f"Attenzione: impossibile rimuovere gs://{GCS_INPUT_BUCKET}/{gcs_blob.name}: {e}")
 
     print("\n--- Fine Processamento ---")
 
 def carica_documento_da_json(json_path: str):
     """
-    Carica un documento JSON (salvato da Document AI) e lo converte in oggetto Document protobuf.
+    Carica un documento JSON (salvato da Document AI, anche compresso .json.gz)
+    e lo converte in oggetto Document protobuf.
     """
     if not os.path.exists(json_path):
         print(f"File non trovato: {json_path}")
         return None
 
-    with open(json_path, "r", encoding="utf-8") as f:
-        json_data = json.load(f)
+    from google.cloud import documentai_v1 as documentai
+
+    opener = gzip.open if json_path.lower().endswith(".gz") else open
+    with opener(json_path, "rt", encoding="utf-8") as f:
+        json_data = f.read()
+
+    # Il testo va direttamente al parser protobuf, senza passare da un dict;
+    # i campi sconosciuti (file salvati con versioni più recenti dell'API) sono ignorati
+    return documentai.Document.from_json(json_data, ignore_unknown_fields=True)
+
+
+def carica_documento_da_pb(pb_path: str):
+    """
+    Carica un documento salvato in binario (.pb, DOCUMENT_AI_SAVE_BINARY=1)
+    e lo converte in oggetto Document protobuf.
+    """
+    if not os.path.exists(pb_path):
+        print(f"File non trovato: {pb_path}")
+        return None
+
+    from google.cloud import documentai_v1 as documentai
+
+    with open(pb_path, "rb") as f:
+        return documentai.Document.deserialize(f.read())
 
-    # Corretto: restituisce direttamente il documento caricato
-    document = documentai.Document.from_json(json.dumps(json_data))
-    return document
 
+def carica_documento(path: str):
+    """Carica un documento Document AI salvato in JSON (anche .json.gz) o in binario (.pb)."""
+    if path.lower().endswith(".pb"):
+        return carica_documento_da_pb(path)
+    return carica_documento_da_json(path)
+
+
+def _percorso_rimappato(path: str) -> str:
+    """Percorso del JSON rimappato accanto al file caricato (x.json, x.json.gz, x.pb -> x.rimappato.json)."""
+    nome = os.path.basename(path)
+    if nome.lower().endswith(".gz"):
+        nome = nome[:-3]
+    return os.path.join(os.path.dirname(path), f"{os.path.splitext(nome)[0]}.rimappato.json")
+
+
+
+def elabora_pdf(root, file_paths):
+    """Invia i PDF a Document AI: un'unica richiesta batch oppure richieste online in parallelo."""
+    if BATCH_MODE:
+        _esegui_in_background(root, process_documents_batch, [list(file_paths)])
+    else:
+        _esegui_in_background(root, process_document, file_paths, max_workers=PARALLEL_REQUESTS)
 
 
 # FINE DEFINIZIONE FUNZIONI
 
 # Punto di ingresso dello script
 if __name__ == "__main__":
-    # Inizializza un'istanza Tkinter ma la nasconde per non mostrare una finestra vuota
-    root = tk.Tk()
-    root.withdraw()
-
-    # Se è stato passato un file da terminale
+    # Se è stato passato un file da terminale: nessuna interfaccia grafica,
+    # i messaggi vengono stampati
     if len(sys.argv) > 1:
         input_path = sys.argv[1]
         if input_path.lower().endswith(".pdf"):
-            process_document(input_path)
-        elif input_path.lower().endswith(".json"):
-            document_proto = carica_documento_da_json(input_path)
+            # Si possono passare più PDF: python gdocai.py a.pdf b.pdf ...
+            elabora_pdf(None, sys.argv[1:])
+        elif input_path.lower().endswith((".json", ".json.gz", ".pb")):
+            document_proto = carica_documento(input_path)
             if document_proto:
                 dati_trasformati = rimappa_json(document_proto)
-                out_filename = f"{os.path.splitext(os.path.basename(input_path))[0]}.rimappato.json"
-                out_path = os.path.join(os.path.dirname(input_path), out_filename)
-                with open(out_path, "w", encoding="utf-8") as f:
-                    json.dump(dati_trasformati, f, ensure_ascii=False, indent=2)
+                out_path = _percorso_rimappato(input_path)
+                with open(out_path, "wb") as f:
+                    json_utils.dump(dati_trasformati, f, indent=True)
                 print(f"\n✅ Rimappatura completata. File salvato in: {out_path}")
-                messagebox.showinfo("Rimappatura Completata", f"Output salvato in:\n{out_path}")
             else:
-                messagebox.showerror("Errore", "Impossibile caricare il file JSON.")
+                _report_error("Errore", "Impossibile caricare il file JSON.")
                 sys.exit(1)
         else:
-            messagebox.showerror("Errore", "Formato file non supportato. Usa PDF o JSON.")
+            _report_error("Errore", "Formato file non supportato. Usa PDF, JSON o PB.")
             sys.exit(1)
 
     else:
+        tk, filedialog, messagebox = _use_gui()
+        # Inizializza un'istanza Tkinter ma la nasconde per non mostrare una finestra vuota
+        root = tk.Tk()
+        root.withdraw()
+
         # Nessun file passato: chiedi all'utente se vuole processare un PDF o rimappare un JSON
         scelta = messagebox.askquestion(
             "Selezione modalità",
@@ -377,32 +835,31 @@ if __name__ == "__main__":
 
         if scelta == "yes":
             # Carica PDF e processa
-            messagebox.showinfo("Seleziona File PDF", "Seleziona il file PDF (DDT o Ordine) da processare.")
-            file_path = filedialog.askopenfilename(
+            messagebox.showinfo("Seleziona File PDF", "Seleziona uno o più file PDF (DDT o Ordini) da processare.")
+            file_paths = filedialog.askopenfilenames(
                 title="Seleziona File PDF per Document AI",
                 filetypes=[("PDF files", "*.pdf")]
             )
-            if file_path:
-                process_document(file_path)
+            if file_paths:
+                elabora_pdf(root, file_paths)
             else:
                 messagebox.showinfo("Selezione Annullata", "Nessun file selezionato. Operazione annullata.")
                 sys.exit(0)
 
         else:
             # Carica JSON locale e rimappa
-            messagebox.showinfo("Seleziona File JSON", "Seleziona un file JSON salvato da Document AI.")
+            messagebox.showinfo("Seleziona File JSON", "Seleziona un file JSON (.json, .json.gz o .pb) salvato da Document AI.")
             json_file_path = filedialog.askopenfilename(
                 title="Seleziona File JSON da Rimappare",
-                filetypes=[("JSON files", "*.json")]
+                filetypes=[("Document AI", "*.json *.json.gz *.pb"), ("JSON files", "*.json *.json.gz"), ("Protobuf files", "*.pb")]
             )
             if json_file_path:
-                document_proto = carica_documento_da_json(json_file_path)
+                document_proto = carica_documento(json_file_path)
                 if document_proto:
                     dati_trasformati = rimappa_json(document_proto)
-                    out_filename = f"{os.path.splitext(os.path.basename(json_file_path))[0]}.rimappato.json"
-                    out_path = os.path.join(os.path.dirname(json_file_path), out_filename)
-                    with open(out_path, "w", encoding="utf-8") as f:
-                        json.dump(dati_trasformati, f, ensure_ascii=False, indent=2)
+                    out_path = _percorso_rimappato(json_file_path)
+                    with open(out_path, "wb") as f:
+                        json_utils.dump(dati_trasformati, f, indent=True)
                     messagebox.showinfo("Rimappatura Completata", f"Output salvato in:\n{out_path}")
                     print(f"\n✅ Rimappatura completata. File salvato in: {out_path}")
                 else:
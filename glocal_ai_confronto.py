@@ -17,12 +17,12 @@ approcci diversi:
   presente nel modulo ``gdocai.rimappa_json``.
 
 * **ChatGPT/LLM** – tramite l’OCR locale e un modello di grande
-  linguaggio (LLM).  Lo script utilizza le funzioni esistenti
-  ``extract_text_from_pdf`` (da ``pdf_reader.py``) e
-  ``extract_data_from_text`` (da ``llm_agent.py``) per ottenere un
-  testo OCR dal PDF e quindi far estrarre i campi desiderati dal
-  modello LLM.  Il modello e il provider possono essere
-  specificati tramite opzioni della CLI.
+  linguaggio (LLM).  Lo script utilizza la funzione esistente
+  ``extract_text_from_pdf`` (da ``pdf_reader.py``) per ottenere un
+  testo OCR dal PDF e chiama poi direttamente il modello tramite l'SDK
+  ``openai`` (structured output con lo schema JSON atteso) per far
+  estrarre i campi desiderati.  Il modello e il provider possono
+  essere specificati tramite opzioni della CLI.
 
 L’utente può scegliere quale metodo utilizzare (``google``,
 ``chatgpt`` oppure ``both``) ed il risultato viene stampato come
@@ -35,6 +35,9 @@ Esempio d’uso:
 
     python glocal_ai_confronto.py ~/documenti/ddt.pdf --method both
 
+Si possono passare più PDF: le estrazioni vengono eseguite in parallelo
+(``--workers``) e il risultato è raggruppato per file.
+
 Requisiti:
 
 * Per usare Document AI occorre impostare le variabili d’ambiente
@@ -45,15 +48,31 @@ Requisiti:
   ``DOCUMENT_AI_LOCATION``.
 * Per usare ChatGPT occorre una chiave API valida per il provider
   scelto (OpenAI oppure OpenRouter) e definita nelle variabili
-  d’ambiente corrispondenti.  La funzione ``extract_data_from_text``
-  definita in ``llm_agent.py`` utilizza le librerie ``langchain`` e
-  ``ChatOpenAI``.
+  d’ambiente corrispondenti (``OPENAI_API_KEY`` oppure
+  ``OPENROUTER_API_KEY``) e il pacchetto ``openai``; ``langchain`` non
+  è necessario.
 """
 
 import argparse
-import json
 import os
-from typing import Dict, Any, List, Sequence, Optional, Iterable
+import re
+import sys
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from operator import attrgetter
+from typing import Callable, Dict, Any, List, Sequence, Optional
+
+import extraction_cache
+import json_utils
+# Helper di rimappatura condivisi con gdocai.py (senza dipendenze da tkinter)
+from rimappa_utils import (
+    _get_entities, _get_pages, _get_entity_type, _get_entity_mention, _get_entity_properties,
+    _get_property_type, _get_property_mention, _get_document_text, _get_tables,
+    _get_header_rows, _get_body_rows, _get_cells, _cell_text, _canon, _parse_number,
+    _pb_type, _pb_mention, _pb_cell_text,
+)
 
 # Carica automaticamente le variabili dal file .env se presente.
 try:
@@ -66,152 +85,13 @@ except Exception:
     pass
 
 
-def _getattr(obj: Any, attr: str, default: Optional[Any] = None) -> Any:
-    """Recupera un attributo da un oggetto oppure una chiave da un dizionario.
-
-    Se ``obj`` è ``None``, restituisce ``default``.  Se ``obj`` è un
-    dizionario, usa ``obj.get(attr, default)``, altrimenti usa
-    ``getattr(obj, attr, default)``.
-    """
-    if obj is None:
-        return default
-    if isinstance(obj, dict):
-        return obj.get(attr, default)
-    return getattr(obj, attr, default)
-
-
-def _get_entities(document: Any) -> Sequence[Any]:
-    """Restituisce la sequenza di entità dal documento."""
-    return _getattr(document, "entities", []) or []
-
-
-def _get_pages(document: Any) -> Sequence[Any]:
-    """Restituisce la sequenza di pagine dal documento."""
-    return _getattr(document, "pages", []) or []
-
-
-def _get_entity_type(entity: Any) -> str:
-    """Restituisce il tipo di entità in minuscolo."""
-    return (_getattr(entity, "type_", None) or _getattr(entity, "type", "")).lower()
-
-
-def _get_entity_mention(entity: Any) -> str:
-    """Restituisce il testo associato a un'entità."""
-    return (
-        _getattr(entity, "mention_text", None)
-        or _getattr(entity, "mentionText", "")
-        or ""
-    ).strip()
-
-
-def _get_entity_properties(entity: Any) -> Sequence[Any]:
-    """Restituisce la sequenza di proprietà di un'entità."""
-    return _getattr(entity, "properties", []) or []
-
-
-def _get_property_type(prop: Any) -> str:
-    """Restituisce il tipo di una proprietà in minuscolo."""
-    return (_getattr(prop, "type_", None) or _getattr(prop, "type", "")).lower()
-
-
-def _get_property_mention(prop: Any) -> str:
-    """Restituisce il testo associato a una proprietà."""
-    return (
-        _getattr(prop, "mention_text", None)
-        or _getattr(prop, "mentionText", "")
-        or ""
-    ).strip()
-
-
-def _get_document_text(document: Any) -> str:
-    """Restituisce il testo completo del documento."""
-    return _getattr(document, "text", "") or ""
-
-
-def _get_tables(page: Any) -> Sequence[Any]:
-    """Restituisce la sequenza di tabelle presenti in una pagina."""
-    return _getattr(page, "tables", []) or []
-
-
-def _get_header_rows(table: Any) -> Sequence[Any]:
-    """Restituisce le righe di intestazione della tabella."""
-    return _getattr(table, "header_rows", None) or _getattr(table, "headerRows", []) or []
-
-
-def _get_body_rows(table: Any) -> Sequence[Any]:
-    """Restituisce le righe del corpo della tabella."""
-    return _getattr(table, "body_rows", None) or _getattr(table, "bodyRows", []) or []
-
-
-def _get_cells(row: Any) -> Sequence[Any]:
-    """Restituisce le celle di una riga."""
-    return _getattr(row, "cells", []) or []
-
-
-def _get_layout(cell: Any) -> Any:
-    """Restituisce il layout di una cella."""
-    return _getattr(cell, "layout", {}) or {}
-
-
-def _get_text_anchor(layout: Any) -> Any:
-    """Restituisce l'ancora di testo di un layout."""
-    return _getattr(layout, "text_anchor", None) or _getattr(layout, "textAnchor", {}) or {}
-
-
-def _get_text_segments(anchor: Any) -> Sequence[Any]:
-    """Restituisce i segmenti di testo dell'ancora."""
-    return _getattr(anchor, "text_segments", None) or _getattr(anchor, "textSegments", []) or []
-
-
-def _extract_text_from_segments(segments: Iterable[Any], full_text: str) -> str:
-    """Compone il testo concatenando tutti i segmenti indicati."""
-    text = ""
-    for seg in segments:
-        start = _getattr(seg, "start_index", None)
-        if start is None:
-            start = _getattr(seg, "startIndex", 0)
-        end = _getattr(seg, "end_index", None)
-        if end is None:
-            end = _getattr(seg, "endIndex", 0)
-        try:
-            start = int(start)
-            end = int(end)
-        except Exception:
-            continue
-        text += full_text[start:end]
-    return text.strip()
-
-
-def _cell_text(cell: Any, full_text: str) -> str:
-    """Estrae il testo da una cella di tabella."""
-    layout = _get_layout(cell)
-    anchor = _get_text_anchor(layout)
-    segments = _get_text_segments(anchor)
-    return _extract_text_from_segments(segments, full_text) if segments else ""
-
-
-def _parse_number(value_str: Optional[str]) -> Optional[float]:
-    """Converte una stringa in float, gestendo il formato italiano (virgola).
-
-    Se ``value_str`` è ``None`` o non è convertibile in numero, restituisce
-    ``None``.
-    """
-    if not value_str:
-        return None
-    try:
-        cleaned = value_str.replace(".", "").replace(",", ".")
-        return float(cleaned)
-    except Exception:
-        return None
-
-
 def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
     """Rimappa l'output di Document AI in una struttura semplificata.
 
     Questa funzione replica la logica presente in ``gdocai.rimappa_json``
     evitando di importare il modulo ``gdocai`` (che potrebbe richiedere
-    ``tkinter``) e utilizzando invece le funzioni helper definite
-    localmente.  Restituisce un dizionario con i campi:
+    ``tkinter``) e utilizzando invece le funzioni helper condivise di
+    ``rimappa_utils``.  Restituisce un dizionario con i campi:
     ``fornitore``, ``numero_documento``, ``data_documento`` e un array
     ``riga`` di righe di dettaglio (progressivo_riga, riferimento,
     codice_articolo, descrizione, quantità, prezzo).
@@ -223,13 +103,38 @@ def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
         "riga": [],
     }
 
-    # Testo completo usato per estrarre il contenuto delle celle
-    full_text = _get_document_text(document_proto)
-
-    # 1) Campi principali dal blocco entità
-    for ent in _get_entities(document_proto):
-        etype = _get_entity_type(ent).lower()
-        evalue = _get_entity_mention(ent)
+    # Accessori scelti una volta per documento: con un Document protobuf si
+    # lavora sul messaggio sottostante (_pb) leggendo i campi direttamente
+    # (attrgetter, _pb_*), senza il controllo isinstance/getattr di _getattr e
+    # i ripieghi sui nomi camelCase a ogni accesso; con un dizionario (JSON)
+    # restano gli helper generici
+    document_proto = getattr(document_proto, "_pb", document_proto)
+    if isinstance(document_proto, dict):
+        get_entities, get_pages, get_tables = _get_entities, _get_pages, _get_tables
+        get_header_rows, get_body_rows = _get_header_rows, _get_body_rows
+        get_cells, get_properties = _get_cells, _get_entity_properties
+        entity_type, entity_mention = _get_entity_type, _get_entity_mention
+        property_type, property_mention = _get_property_type, _get_property_mention
+        cell_text = _cell_text
+        full_text = _get_document_text(document_proto)
+    else:
+        get_entities, get_pages, get_tables = attrgetter("entities"), attrgetter("pages"), attrgetter("tables")
+        get_header_rows, get_body_rows = attrgetter("header_rows"), attrgetter("body_rows")
+        get_cells, get_properties = attrgetter("cells"), attrgetter("properties")
+        entity_type = property_type = _pb_type
+        entity_mention = property_mention = _pb_mention
+        cell_text = _pb_cell_text
+        full_text = document_proto.text
+
+    # 1) Campi principali dal blocco entità; le entità "riga" vengono
+    # raccolte nello stesso passaggio per il punto 3
+    righe_entities = []
+    for ent in get_entities(document_proto):
+        etype = entity_type(ent)
+        if etype == "riga":
+            righe_entities.append(ent)
+            continue
+        evalue = entity_mention(ent)
         if "fornitore" in etype:
             risultato["fornitore"] = evalue
         elif "numero" in etype:
@@ -239,38 +144,40 @@ def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
 
     # 2) Costruisci l'elenco di righe di tabella con codice, quantità e prezzo unitario
     prod_rows: List[Dict[str, Any]] = []
-    for page in _get_pages(document_proto):
-        for table in _get_tables(page):
-            header_rows = _get_header_rows(table)
+    for page in get_pages(document_proto):
+        for table in get_tables(page):
+            header_rows = get_header_rows(table)
             if not header_rows:
                 continue
             first_header_row = header_rows[0]
-            header_cells = _get_cells(first_header_row)
-            header = [_cell_text(cell, full_text).lower() for cell in header_cells]
-
-            if "codice articolo" not in header:
-                continue
-            idx_cod = header.index("codice articolo")
-            idx_quant = header.index("quantita'") if "quantita'" in header else None
-            idx_price_unit = header.index("prezzo unitario") if "prezzo unitario" in header else None
-            idx_price_tot = header.index("prezzo totale") if "prezzo totale" in header else None
-            if idx_quant is None:
+            header_cells = get_cells(first_header_row)
+            # Intestazioni normalizzate e indicizzate una sola volta: ogni
+            # colonna si trova con una lookup invece di scandire la lista
+            col_idx: Dict[str, int] = {}
+            for i, cell in enumerate(header_cells):
+                col_idx.setdefault(_canon(cell_text(cell, full_text)), i)
+
+            idx_cod = col_idx.get("codice articolo")
+            idx_quant = col_idx.get("quantita")
+            idx_price_unit = col_idx.get("prezzo unitario")
+            idx_price_tot = col_idx.get("prezzo totale")
+            if idx_cod is None or idx_quant is None:
                 continue
 
-            for body_row in _get_body_rows(table):
-                cells = _get_cells(body_row)
+            for body_row in get_body_rows(table):
+                cells = get_cells(body_row)
                 if idx_cod >= len(cells) or idx_quant >= len(cells):
                     continue
-                code = _cell_text(cells[idx_cod], full_text)
-                quant_str = _cell_text(cells[idx_quant], full_text)
+                code = cell_text(cells[idx_cod], full_text)
+                quant_str = cell_text(cells[idx_quant], full_text)
                 qty = _parse_number(quant_str)
                 if code and qty is not None:
                     price_unit = None
                     price_tot = None
                     if idx_price_unit is not None and idx_price_unit < len(cells):
-                        price_unit = _parse_number(_cell_text(cells[idx_price_unit], full_text))
+                        price_unit = _parse_number(cell_text(cells[idx_price_unit], full_text))
                     if idx_price_tot is not None and idx_price_tot < len(cells):
-                        price_tot = _parse_number(_cell_text(cells[idx_price_tot], full_text))
+                        price_tot = _parse_number(cell_text(cells[idx_price_tot], full_text))
                     if price_unit is None and price_tot is not None and qty != 0:
                         price_unit = price_tot / qty
                     prod_rows.append({
@@ -284,31 +191,40 @@ def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
     for row in prod_rows:
         if row["prezzo"] is not None and row["codice_articolo"] not in price_map:
             price_map[row["codice_articolo"]] = row["prezzo"]
-    prod_remaining = prod_rows.copy()
+
+    # Indici delle righe di tabella per codice e per (codice, quantità), in ordine
+    # di apparizione: ogni ricerca è O(1) invece di una scansione della lista.
+    # Una riga abbinata finisce in "usate" e viene scartata dall'altro indice
+    # alla prima lettura successiva.
+    by_code: Dict[str, deque] = defaultdict(deque)
+    by_code_qty: Dict[tuple, deque] = defaultdict(deque)
+    for i, row in enumerate(prod_rows):
+        by_code[row["codice_articolo"]].append(i)
+        by_code_qty[(row["codice_articolo"], round(row["quantita"], 6))].append(i)
+    usate = set()
+
+    def prima_libera(coda: Optional[deque]) -> Optional[int]:
+        while coda and coda[0] in usate:
+            coda.popleft()
+        return coda.popleft() if coda else None
 
     def match_price(code: str, qty: Optional[float]) -> Optional[float]:
         if not code:
             return None
+        i = None
         if qty is not None:
-            for i, row in enumerate(prod_remaining):
-                if row["codice_articolo"] == code and abs(row["quantita"] - qty) < 1e-6:
-                    p = row["prezzo"]
-                    prod_remaining.pop(i)
-                    return p
-        for i, row in enumerate(prod_remaining):
-            if row["codice_articolo"] == code:
-                p = row["prezzo"]
-                prod_remaining.pop(i)
-                return p
-        return None
+            i = prima_libera(by_code_qty.get((code, round(qty, 6))))
+        if i is None:
+            i = prima_libera(by_code.get(code))
+        if i is None:
+            return None
+        usate.add(i)
+        return prod_rows[i]["prezzo"]
 
     # 3) crea la lista delle righe dalle entità di tipo "riga"
-    for ent in _get_entities(document_proto):
-        if _get_entity_type(ent).lower() != "riga":
-            continue
-        props: Dict[str, str] = {}
-        for prop in _get_entity_properties(ent):
-            props[_get_property_type(prop)] = _get_property_mention(prop)
+    righe = risultato["riga"]
+    for progressivo, ent in enumerate(righe_entities, 1):
+        props: Dict[str, str] = {property_type(prop): property_mention(prop) for prop in get_properties(ent)}
         code = props.get("codice_articolo", "")
         qty_str = props.get("quantita") or props.get("quantità")
         qty = _parse_number(qty_str) if qty_str else None
@@ -317,8 +233,8 @@ def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
             price = price_map[code]
         if price is None:
             price = 0.0
-        risultato["riga"].append({
-            "progressivo_riga": str(len(risultato["riga"]) + 1),
+        righe.append({
+            "progressivo_riga": str(progressivo),
             "riferimento": props.get("riferimento", ""),
             "codice_articolo": code,
             "descrizione": props.get("descrizione", ""),
@@ -329,35 +245,84 @@ def rimappa_document_ai(document_proto: Any) -> Dict[str, Any]:
     return risultato
 
 
-def extract_with_google_document_ai(file_path: str) -> Dict[str, Any]:
+# Campi del Document richiesti a Document AI se DOCUMENT_AI_FIELD_MASK non è
+# impostata: solo quelli letti da rimappa_document_ai (testo, entità con le
+# loro proprietà, tabelle).  Immagini delle pagine, token e stili non vengono
+# trasmessi né decodificati.  DOCUMENT_AI_FIELD_MASK=* richiede il documento completo
+_DEFAULT_FIELD_MASK = "text,entities,pages.tables"
+
+
+def _field_mask() -> Optional[str]:
+    """Field mask da usare nella richiesta (``None`` = documento completo)."""
+    field_mask = os.getenv("DOCUMENT_AI_FIELD_MASK") or _DEFAULT_FIELD_MASK
+    return None if field_mask == "*" else field_mask
+
+
+@lru_cache(maxsize=1)
+def _load_documentai() -> Any:
+    """Importa ``documentai_v1`` solo al primo uso (non serve con ``--method chatgpt``)."""
+    try:
+        from google.cloud import documentai_v1 as documentai
+    except ImportError as e:
+        raise RuntimeError(
+            "Il pacchetto google-cloud-documentai non è installato. "
+            "Per utilizzare Document AI installa 'google-cloud-documentai'."
+        ) from e
+    return documentai
+
+
+@lru_cache(maxsize=4)
+def _get_documentai_client(location: str) -> Any:
+    """Client Document AI per ``location``, creato una sola volta.
+
+    Il client è thread-safe: i documenti elaborati in parallelo condividono
+    lo stesso canale gRPC invece di aprirne (e autenticarne) uno a testa.
+    """
+    from google.api_core.client_options import ClientOptions
+
+    client_options = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+    return _load_documentai().DocumentProcessorServiceClient(client_options=client_options)
+
+
+@lru_cache(maxsize=1)
+def _get_storage_client() -> Any:
+    """Client Google Cloud Storage, creato una sola volta."""
+    from google.cloud import storage
+    return storage.Client()
+
+
+def extract_with_google_document_ai(file_path: str, gcs_bucket: Optional[str] = None,
+                                    content: Optional[bytes] = None) -> Dict[str, Any]:
     """Esegue l’estrazione tramite Google Document AI su un file PDF.
 
     Per funzionare è necessario impostare le variabili d’ambiente
     ``GOOGLE_CLOUD_PROJECT_ID`` (ID del progetto GCP),
     ``DOCUMENT_AI_PROCESSOR_ID`` (ID numerico del processore) e
     facoltativamente ``DOCUMENT_AI_LOCATION`` (la regione, default
-    ``eu``), ``DOCUMENT_AI_FIELD_MASK`` e
+    ``eu``), ``DOCUMENT_AI_FIELD_MASK`` (default: solo testo, entità e
+    tabelle; ``*`` per il documento completo) e
     ``DOCUMENT_AI_PROCESS_FIRST_PAGE_ONLY``.  Inoltre, devono essere
     presenti le credenziali di servizio per accedere a Document AI,
     tipicamente tramite la variabile ``GOOGLE_APPLICATION_CREDENTIALS``.
 
+    Se è indicato ``gcs_bucket`` (o la variabile ``DOCUMENT_AI_GCS_INPUT_BUCKET``)
+    il PDF viene caricato a blocchi su Google Cloud Storage e Document AI lo
+    legge da lì: il file non viene inviato nella richiesta.
+
+    ``content`` sono i byte del PDF già letti dal chiamante: se indicati il
+    file non viene riletto dal disco.
+
     Restituisce un dizionario con la struttura semplificata definita
     da ``rimappa_document_ai``.
     """
-    try:
-        from google.cloud import documentai_v1 as documentai
-        from google.api_core.client_options import ClientOptions
-    except ImportError as e:
-        raise RuntimeError(
-            "Il pacchetto google-cloud-documentai non è installato. "
-            "Per utilizzare Document AI installa 'google-cloud-documentai'."
-        ) from e
+    documentai = _load_documentai()
 
     project_id = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
     location = os.getenv("DOCUMENT_AI_LOCATION", "eu")
     processor_id = os.getenv("DOCUMENT_AI_PROCESSOR_ID")
-    field_mask = os.getenv("DOCUMENT_AI_FIELD_MASK", None)
+    field_mask = _field_mask()
     process_first_page_only = os.getenv("DOCUMENT_AI_PROCESS_FIRST_PAGE_ONLY", "0").lower() == "1"
+    gcs_bucket = gcs_bucket or os.getenv("DOCUMENT_AI_GCS_INPUT_BUCKET")
 
     if not project_id or not processor_id:
         raise RuntimeError(
@@ -366,13 +331,26 @@ def extract_with_google_document_ai(file_path: str) -> Dict[str, Any]:
         )
 
     processor_path = f"projects/{project_id}/locations/{location}/processors/{processor_id}"
-    client_options = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-    client = documentai.DocumentProcessorServiceClient(client_options=client_options)
-
-    # Leggi il PDF
-    with open(file_path, "rb") as document_file:
-        document_content = document_file.read()
-    raw_document = documentai.RawDocument(content=document_content, mime_type="application/pdf")
+    client = _get_documentai_client(location)
+
+    gcs_blob = None
+    if gcs_bucket:
+        # Upload a blocchi da 8 MiB (resumable): il PDF non passa dalla memoria
+        gcs_blob = _get_storage_client().bucket(gcs_bucket).blob(
+            f"glocal_ai/input/{uuid.uuid4().hex}_{os.path.basename(file_path)}",
+            chunk_size=8 * 1024 * 1024,
+        )
+        gcs_blob.upload_from_filename(file_path, content_type="application/pdf", timeout=300)
+        document_source = {"gcs_document": documentai.GcsDocument(
+            gcs_uri=f"gs://{gcs_bucket}/{gcs_blob.name}", mime_type="application/pdf"
+        )}
+    else:
+        # Leggi il PDF (se il chiamante non ne ha già passato il contenuto)
+        document_content = content
+        if document_content is None:
+            with open(file_path, "rb") as document_file:
+                document_content = document_file.read()
+        document_source = {"raw_document": documentai.RawDocument(content=document_content, mime_type="application/pdf")}
 
     process_options = None
     if process_first_page_only:
@@ -382,51 +360,86 @@ def extract_with_google_document_ai(file_path: str) -> Dict[str, Any]:
 
     request = documentai.ProcessRequest(
         name=processor_path,
-        raw_document=raw_document,
+        **document_source,
         field_mask=field_mask,
         process_options=process_options,
     )
 
-    result = client.process_document(request=request)
+    try:
+        result = client.process_document(request=request)
+    finally:
+        # Il PDF su GCS serve solo per questa richiesta
+        if gcs_blob is not None:
+            try:
+                gcs_blob.delete()
+            except Exception as e:
+                print(f"[Attenzione] Impossibile rimuovere gs://{gcs_bucket}/{gcs_blob.name}: {e}")
     document_proto = result.document
     return rimappa_document_ai(document_proto)
 
 
-def extract_with_chatgpt(file_path: str, model: str = "gpt-3.5-turbo", provider: str = "openai") -> Dict[str, Any]:
-    """Esegue l’estrazione tramite OCR + modello LLM su un file PDF.
+# Caratteri rilevanti per bilanciare le graffe di un oggetto JSON
+_JSON_SCAN_RE = re.compile(r'[{}"\\]')
 
-    Questo metodo esegue internamente l’OCR tramite ``pdf_reader.extract_text_from_pdf`` e
-    invoca un modello di grande linguaggio (LLM) tramite la libreria
-    ``langchain`` con un prompt specifico.  Il risultato generato dal modello
-    viene decodificato in JSON.  In caso di errori di parsing vengono
-    applicati tentativi di recupero e viene sollevata un’eccezione con
-    informazioni utili.
 
-    :param file_path: percorso del file PDF
-    :param model: nome del modello LLM (es. "gpt-3.5-turbo", "gpt-4")
-    :param provider: provider del modello ("openai" o "openrouter")
-    :return: dizionario con la struttura dei dati estratti
+def _extract_first_json(text: str) -> Optional[str]:
+    """Restituisce il primo oggetto JSON ``{...}`` completo presente in ``text``.
+
+    Le graffe vengono bilanciate saltando quelle dentro le stringhe: testo o
+    blocchi di codice dopo l'oggetto non finiscono nel risultato (come con
+    una regex greedy) e la scansione è lineare, senza backtracking.
+    Restituisce ``None`` se non c'è un oggetto completo.
     """
-    # Effettua l'OCR sul documento
-    try:
-        from pdf_reader import extract_text_from_pdf
-    except Exception as e:
-        raise RuntimeError(
-            "Impossibile importare pdf_reader.extract_text_from_pdf. "
-            "Assicurati che le dipendenze per l'OCR siano installate."
-        ) from e
-    text = extract_text_from_pdf(file_path)
-
-    # Importa i componenti necessari per il prompt e l'LLM
-    from langchain.chains import LLMChain
-    from langchain.prompts import PromptTemplate
-    from langchain_community.chat_models import ChatOpenAI
-    import re
-
-    # Prompt per l'estrazione dei dati, identico a quello usato in llm_agent.py
-    prompt = PromptTemplate(
-        input_variables=["input"],
-        template="""
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_str = False
+    escaped = -1  # posizione del carattere preceduto da "\"
+    for match in _JSON_SCAN_RE.finditer(text, start):
+        pos = match.start()
+        if pos == escaped:
+            continue
+        ch = match.group()
+        if ch == "\\":
+            escaped = pos + 1
+        elif ch == '"':
+            in_str = not in_str
+        elif in_str:
+            continue
+        elif ch == "{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    return None
+
+
+# Versione di _PROMPT_TMPL: va incrementata a ogni modifica del prompt (o del
+# testo passato al modello, vedi _compatta_testo_ocr), così i risultati in
+# cache ottenuti con il prompt precedente non vengono riusati
+PROMPT_VERSION = "3"
+
+# Limite facoltativo (in caratteri) del testo OCR inviato al modello; 0 = nessun limite
+LLM_MAX_INPUT_CHARS = int(os.getenv("LLM_MAX_INPUT_CHARS", "0"))
+
+
+def _compatta_testo_ocr(text: str) -> str:
+    """Riduce il testo OCR prima di inserirlo nel prompt.
+
+    Gli spazi ripetuti di ogni riga diventano uno solo e le righe vuote
+    vengono eliminate: l'OCR ne produce molte e ognuna costa token in input
+    senza aggiungere informazione.  Nessuna riga con testo viene scartata.
+    Se ``LLM_MAX_INPUT_CHARS`` è impostata, il testo viene troncato.
+    """
+    text = "\n".join(" ".join(words) for words in map(str.split, text.splitlines()) if words)
+    if LLM_MAX_INPUT_CHARS > 0:
+        text = text[:LLM_MAX_INPUT_CHARS]
+    return text
+
+# Prompt per l'estrazione dei dati, identico a quello usato in llm_agent.py
+_PROMPT_TMPL = """
 Agisci come un estrattore di dati altamente preciso da Documenti di Trasporto (data).
 Riceverai testo estratto da un PDF (anche via OCR).
 Aggiungi ad ogni riga estratta il progressivo_riga partendo da 1.
@@ -464,50 +477,180 @@ Non generare spiegazioni, restituisci solo il JSON.
 
 Testo di input:
 {input}
-        """,
-    )
+        """
+
+
+@lru_cache(maxsize=2)
+def _get_client(provider: str) -> Any:
+    """Restituisce il client OpenAI per ``provider``, creato una sola volta.
+
+    Il client mantiene il pool di connessioni HTTP: documenti successivi
+    riusano la stessa connessione, in HTTP/2 (più richieste sulla stessa
+    connessione TLS).  OpenRouter espone la stessa API di OpenAI, cambia
+    solo l'endpoint.
+    """
+    from openai import DefaultHttpxClient, OpenAI
 
-    # Selezione del provider e configurazione del modello
     if provider == "openai":
-        try:
-            llm = ChatOpenAI(
-                model_name=model,
-                temperature=0,
-                model_kwargs={"response_format": {"type": "json_object"}},
+        return OpenAI(http_client=DefaultHttpxClient(http2=True))
+    if provider == "openrouter":
+        return OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY"),
+                      http_client=DefaultHttpxClient(http2=True))
+    raise ValueError(f"Provider '{provider}' non supportato al momento.")
+
+
+@lru_cache(maxsize=1)
+def _response_format() -> Dict[str, Any]:
+    """``response_format`` con lo schema JSON della risposta attesa (structured output).
+
+    Lo schema è generato dai modelli pydantic della struttura descritta nel
+    prompt: con ``strict`` il server garantisce un JSON valido e conforme.
+    """
+    from pydantic import BaseModel, ConfigDict
+
+    class Riga(BaseModel):
+        model_config = ConfigDict(extra="forbid")
+        progressivo_riga: Optional[str]
+        riferimento: Optional[str]
+        codice_articolo: Optional[str]
+        descrizione: Optional[str]
+        quantità: Optional[float]
+        prezzo: Optional[float]
+
+    class Documento(BaseModel):
+        model_config = ConfigDict(extra="forbid")
+        fornitore: Optional[str]
+        numero_documento: Optional[str]
+        data_documento: Optional[str]
+        riga: List[Riga]
+
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "documento", "strict": True, "schema": Documento.model_json_schema()},
+    }
+
+
+# Modelli che hanno rifiutato lo schema JSON (structured output non
+# supportato): per questi si usa direttamente la modalità json_object
+_SENZA_SCHEMA = set()
+
+
+def _errore_schema(exc: Exception) -> bool:
+    """True se l'errore 400 riguarda il formato di risposta (schema non supportato dal modello)."""
+    testo = f"{getattr(exc, 'code', '') or ''} {exc}".lower()
+    return "response_format" in testo or "json_schema" in testo
+
+# Instradamento OpenRouter: provider ordinati per latenza e passaggio
+# automatico al successivo se quello scelto è degradato o non risponde
+_OPENROUTER_ROUTING = {"provider": {"allow_fallbacks": True, "sort": "latency"}}
+
+
+def _chiedi_al_modello(text: str, model: str, provider: str,
+                       on_chunk: Optional[Callable[[str], None]] = None,
+                       on_provider: Optional[Callable[[str], None]] = None) -> str:
+    """Invia il prompt al modello e restituisce il testo della risposta.
+
+    Con ``on_chunk`` la risposta viene ricevuta in streaming e ogni frammento
+    di testo viene passato alla callback appena arriva (per mostrare
+    l'avanzamento); il valore restituito è comunque la risposta completa.
+    Con OpenRouter ``on_provider`` riceve il nome del provider che ha
+    effettivamente servito la richiesta.
+    """
+    from openai import BadRequestError
+
+    client = _get_client(provider)
+    messages = [{"role": "user", "content": _PROMPT_TMPL.format(input=text)}]
+    extra_body = _OPENROUTER_ROUTING if provider == "openrouter" else None
+
+    def segnala_provider(response: Any) -> None:
+        # OpenRouter aggiunge alla risposta il campo non standard "provider"
+        served_by = getattr(response, "provider", None)
+        if on_provider is not None and served_by:
+            on_provider(served_by)
+
+    def completa(response_format: Dict[str, Any]) -> str:
+        if on_chunk is None:
+            completion = client.chat.completions.create(
+                model=model, messages=messages, temperature=0, response_format=response_format,
+                extra_body=extra_body,
             )
-        except TypeError:
-            llm = ChatOpenAI(model_name=model, temperature=0)
-    elif provider == "openrouter":
+            segnala_provider(completion)
+            return completion.choices[0].message.content or ""
+        parts = []
+        stream = client.chat.completions.create(
+            model=model, messages=messages, temperature=0, response_format=response_format, stream=True,
+            extra_body=extra_body,
+        )
+        for i, chunk in enumerate(stream):
+            if i == 0:
+                segnala_provider(chunk)
+            # Alcuni chunk (es. quello finale con l'utilizzo dei token) non hanno testo
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                on_chunk(delta)
+        return "".join(parts)
+
+    if (provider, model) not in _SENZA_SCHEMA:
         try:
-            llm = ChatOpenAI(
-                model_name=model,
-                temperature=0,
-                openai_api_base="https://openrouter.ai/api/v1",
-                openai_api_key=os.getenv("OPENROUTER_API_KEY"),
-                model_kwargs={"response_format": {"type": "json_object"}},
-            )
-        except TypeError:
-            llm = ChatOpenAI(
-                model_name=model,
-                temperature=0,
-                openai_api_base="https://openrouter.ai/api/v1",
-                openai_api_key=os.getenv("OPENROUTER_API_KEY"),
-            )
+            return completa(_response_format())
+        except BadRequestError as exc:
+            # Modelli meno recenti (es. gpt-3.5-turbo) non accettano json_schema;
+            # gli altri errori 400 (es. contesto troppo lungo) vanno propagati
+            if not _errore_schema(exc):
+                raise
+            _SENZA_SCHEMA.add((provider, model))
+    return completa({"type": "json_object"})
+
+
+def extract_with_chatgpt(file_path: str, model: str = "gpt-3.5-turbo", provider: str = "openai",
+                         content: Optional[bytes] = None,
+                         on_chunk: Optional[Callable[[str], None]] = None,
+                         on_provider: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Esegue l’estrazione tramite OCR + modello LLM su un file PDF.
+
+    Questo metodo esegue internamente l’OCR tramite ``pdf_reader.extract_text_from_pdf`` e
+    invoca un modello di grande linguaggio (LLM) tramite l'SDK ``openai``
+    con un prompt specifico, chiedendo una risposta conforme allo schema
+    JSON atteso.  Il risultato generato dal modello viene decodificato in
+    JSON.  Per i modelli senza structured output (modalità ``json_object``)
+    in caso di errori di parsing vengono applicati tentativi di recupero e
+    viene sollevata un’eccezione con informazioni utili.
+
+    :param file_path: percorso del file PDF
+    :param model: nome del modello LLM (es. "gpt-3.5-turbo", "gpt-4")
+    :param provider: provider del modello ("openai" o "openrouter")
+    :param content: byte del PDF già letti (l'OCR non rilegge il file)
+    :param on_chunk: callback chiamata con ogni frammento della risposta
+                     ricevuta in streaming (avanzamento)
+    :param on_provider: callback chiamata con il provider che ha servito la
+                        richiesta (solo OpenRouter)
+    :return: dizionario con la struttura dei dati estratti
+    """
+    # Effettua l'OCR sul documento
+    try:
+        from pdf_reader import extract_text_from_pdf, extract_text_from_pdf_bytes
+    except Exception as e:
+        raise RuntimeError(
+            "Impossibile importare pdf_reader.extract_text_from_pdf. "
+            "Assicurati che le dipendenze per l'OCR siano installate."
+        ) from e
+    if content is not None:
+        text = extract_text_from_pdf_bytes(content)
     else:
-        raise ValueError(f"Provider '{provider}' non supportato al momento.")
+        text = extract_text_from_pdf(file_path)
 
-    chain = LLMChain(llm=llm, prompt=prompt)
-    response = chain.run({"input": text})
+    response = _chiedi_al_modello(_compatta_testo_ocr(text), model, provider, on_chunk, on_provider)
 
     # Prova a decodificare direttamente come JSON
     try:
-        return json.loads(response)
+        return json_utils.loads(response)
     except Exception:
         # Cerca la prima struttura JSON nel testo
-        match = re.search(r"\{.*\}", response, re.S)
-        if match:
+        candidate = _extract_first_json(response)
+        if candidate:
             try:
-                return json.loads(match.group(0))
+                return json_utils.loads(candidate)
             except Exception:
                 pass
         raise RuntimeError(
@@ -516,6 +659,38 @@ Testo di input:
         )
 
 
+def _estrai_con_cache(key_parts: Sequence[str], digest: str,
+                      extract: Callable[[], Dict[str, Any]], use_cache: bool = True) -> Dict[str, Any]:
+    """Esegue ``extract`` usando la cache di estrazione (``extraction_cache``).
+
+    La chiave combina ``key_parts`` (metodo e configurazione) con ``digest``,
+    l'hash SHA-256 del contenuto del PDF: rielaborando lo stesso file con la stessa
+    configurazione non si ripetono né l'OCR né le chiamate a Document AI o
+    all'LLM.  Con ``use_cache=False`` la cache viene ignorata.
+    """
+    if not use_cache:
+        return extract()
+    key = extraction_cache.make_key(*key_parts, digest)
+    cached = extraction_cache.get(key)
+    if isinstance(cached, dict):
+        return cached
+    result = extract()
+    extraction_cache.set(key, result)
+    return result
+
+
+def _google_cache_parts() -> List[str]:
+    """Configurazione Document AI che influisce sul risultato, per la chiave di cache."""
+    return [
+        "google",
+        os.getenv("GOOGLE_CLOUD_PROJECT_ID", ""),
+        os.getenv("DOCUMENT_AI_LOCATION", "eu"),
+        os.getenv("DOCUMENT_AI_PROCESSOR_ID", ""),
+        _field_mask() or "*",
+        os.getenv("DOCUMENT_AI_PROCESS_FIRST_PAGE_ONLY", "0"),
+    ]
+
+
 def main() -> None:
     """Punto di ingresso dell’applicazione da CLI."""
     parser = argparse.ArgumentParser(
@@ -526,7 +701,8 @@ def main() -> None:
     )
     parser.add_argument(
         "pdf_path",
-        help="Percorso completo del file PDF da processare."
+        nargs="+",
+        help="Percorso completo del file PDF da processare (anche più di uno)."
     )
     parser.add_argument(
         "--method",
@@ -534,7 +710,7 @@ def main() -> None:
         default="both",
         help=(
             "Metodo di estrazione da utilizzare: "
-            "'google' per Document AI, 'chatgpt' per LLM oppure 'both' per entrambi."
+            "'google' per Document AI, 'chatgpt' per LLM oppure 'both' per entrambi."
         ),
     )
     parser.add_argument(
@@ -547,33 +723,82 @@ def main() -> None:
         default="openai",
         help="Provider LLM (openai oppure openrouter)."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Numero massimo di estrazioni eseguite in parallelo (default 4)."
+    )
+    parser.add_argument(
+        "--gcs-bucket",
+        default=None,
+        help=(
+            "Bucket Google Cloud Storage in cui caricare i PDF per Document AI "
+            "(default: variabile DOCUMENT_AI_GCS_INPUT_BUCKET; se assente il PDF "
+            "viene inviato nella richiesta)."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Non usare la cache dei risultati: OCR, Document AI e LLM vengono sempre rieseguiti."
+    )
 
     args = parser.parse_args()
 
-    pdf_path = args.pdf_path
-    if not os.path.isfile(pdf_path):
-        raise FileNotFoundError(f"Il file specificato non esiste: {pdf_path}")
-
-    results: Dict[str, Any] = {}
-
-    # Esecuzione del metodo Google Document AI
-    if args.method in ("google", "both"):
+    for pdf_path in args.pdf_path:
+        if not os.path.isfile(pdf_path):
+            raise FileNotFoundError(f"Il file specificato non esiste: {pdf_path}")
+
+    use_cache = not args.no_cache
+
+    # Estrazioni da eseguire: (file, metodo, funzione, messaggio di avvio)
+    tasks = []
+    for pdf_path in args.pdf_path:
+        # Il PDF viene letto una sola volta: gli stessi byte servono per l'hash
+        # della cache, per la richiesta a Document AI e per l'OCR
+        with open(pdf_path, "rb") as f:
+            content = f.read()
+        digest = extraction_cache.content_hash(content)
+        if args.method in ("google", "both"):
+            extract = partial(extract_with_google_document_ai, pdf_path,
+                              gcs_bucket=args.gcs_bucket, content=content)
+            tasks.append((pdf_path, "google",
+                          partial(_estrai_con_cache, _google_cache_parts(), digest, extract, use_cache),
+                          f"[Info] Avvio estrazione tramite Google Document AI… ({pdf_path})"))
+        if args.method in ("chatgpt", "both"):
+            extract = partial(extract_with_chatgpt, pdf_path, model=args.model,
+                              provider=args.provider, content=content)
+            cache_parts = ["chatgpt", args.provider, args.model, PROMPT_VERSION, str(LLM_MAX_INPUT_CHARS)]
+            tasks.append((pdf_path, "chatgpt",
+                          partial(_estrai_con_cache, cache_parts, digest, extract, use_cache),
+                          f"[Info] Avvio estrazione tramite ChatGPT/LLM… ({pdf_path})"))
+
+    # Le estrazioni sono in gran parte attesa di rete (Document AI, LLM) e OCR:
+    # eseguite in parallelo (metodi e documenti diversi, con richieste LLM
+    # contemporanee sullo stesso client) il tempo totale è quello delle più lente
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(tasks)))) as executor:
+        futures = []
+        for pdf_path, name, fn, message in tasks:
+            print(message)
+            futures.append((pdf_path, name, executor.submit(fn)))
+
+    results: Dict[str, Dict[str, Any]] = {pdf_path: {} for pdf_path in args.pdf_path}
+    for pdf_path, name, future in futures:
         try:
-            print("[Info] Avvio estrazione tramite Google Document AI…")
-            results["google"] = extract_with_google_document_ai(pdf_path)
+            results[pdf_path][name] = future.result()
         except Exception as e:
-            results["google_error"] = str(e)
+            results[pdf_path][f"{name}_error"] = str(e)
 
-    # Esecuzione del metodo ChatGPT
-    if args.method in ("chatgpt", "both"):
-        try:
-            print("[Info] Avvio estrazione tramite ChatGPT/LLM…")
-            results["chatgpt"] = extract_with_chatgpt(pdf_path, model=args.model, provider=args.provider)
-        except Exception as e:
-            results["chatgpt_error"] = str(e)
+    # Con un solo PDF l'output resta quello di sempre; con più PDF i risultati
+    # sono raggruppati per percorso del file
+    output = results[args.pdf_path[0]] if len(results) == 1 else results
 
     # Stampa il risultato JSON per confronto
-    print(json.dumps(results, indent=2, ensure_ascii=False))
+    # (orjson se disponibile, scritto direttamente in UTF-8 sullo stdout binario)
+    sys.stdout.flush()
+    sys.stdout.buffer.write(json_utils.dumps(output, indent=True) + b"\n")
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
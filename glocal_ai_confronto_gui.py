@@ -21,13 +21,22 @@ una chiave API valida per il provider scelto.
 
 """
 
+import asyncio
+import datetime
 import json
 import os
+import subprocess
+import sys
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, scrolledtext, ttk
 import threading
-import requests
-from typing import Any
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Coroutine
+
+import httpx
+
+import json_utils
 
 # Carichiamo automaticamente variabili da file .env, se presente.  Questo permette
 # di impostare chiavi e configurazioni senza definire manualmente le
@@ -52,6 +61,102 @@ except ImportError as e:
         "contenga le funzioni di estrazione."
     ) from e
 
+# ----------------------------------------------------------------------------
+#   Event loop asincrono in background
+#
+# Le richieste di rete della GUI (elenco dei modelli) vengono eseguite come
+# coroutine su un unico event loop, avviato in un thread daemon al primo
+# uso: il mainloop di Tk non viene bloccato, le richieste possono procedere
+# in parallelo e il client HTTP (HTTP/2, keep-alive) resta aperto tra una
+# richiesta e l'altra.  I risultati vanno riportati sul thread di Tk con
+# root.after().
+_loop: asyncio.AbstractEventLoop | None = None
+_http_client: httpx.AsyncClient | None = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def run_async(coro: Coroutine[Any, Any, Any]) -> Future:
+    """Esegue ``coro`` sull'event loop in background e restituisce il relativo Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    # Usato solo dalle coroutine sull'event loop in background
+    global _http_client
+    if _http_client is None:
+        # Pool di connessioni persistenti (poche destinazioni: OpenAI e
+        # OpenRouter) e nuovi tentativi sugli errori di connessione
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=4, keepalive_expiry=60),
+        )
+        _http_client = httpx.AsyncClient(timeout=10, transport=transport,
+                                         headers={"User-Agent": "glocal-ai/1.0"})
+    return _http_client
+
+
+async def _close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# ----------------------------------------------------------------------------
+#   Cache degli elenchi dei modelli
+#
+# L'elenco dei modelli di un provider cambia raramente: viene memorizzato
+# per MODEL_CACHE_TTL secondi (default un'ora) in memoria e su disco in
+# ~/.cache/glocal_ai, così anche al riavvio della GUI la combobox si
+# popola subito senza interrogare le API.
+MODEL_CACHE_TTL = float(os.getenv("GLOCAL_MODEL_CACHE_TTL", "3600"))
+MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "glocal_ai")
+_model_cache: dict[str, tuple[float, list[str]]] = {}
+
+
+def _model_cache_path(provider: str) -> str:
+    return os.path.join(MODEL_CACHE_DIR, f"models_{provider}.json")
+
+
+def _cached_models(provider: str) -> list[str] | None:
+    """Restituisce l'elenco dei modelli in cache se non è scaduto, altrimenti ``None``."""
+    entry = _model_cache.get(provider)
+    if entry is None:
+        # Prima richiesta per il provider: si prova la cache su disco
+        try:
+            with open(_model_cache_path(provider), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            entry = (float(data["fetched_at"]), [str(m) for m in data["models"]])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        _model_cache[provider] = entry
+    fetched_at, models = entry
+    if time.time() - fetched_at >= MODEL_CACHE_TTL:
+        return None
+    return models
+
+
+def _store_models(provider: str, models: list[str]) -> None:
+    """Memorizza l'elenco dei modelli in memoria e su disco (scrittura atomica)."""
+    fetched_at = time.time()
+    _model_cache[provider] = (fetched_at, models)
+    try:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = _model_cache_path(provider) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": fetched_at, "models": models}, f)
+        os.replace(tmp_path, _model_cache_path(provider))
+    except OSError:
+        pass
+
 
 # ----------------------------------------------------------------------------
 #   AutocompleteCombobox
@@ -74,6 +179,11 @@ class AutocompleteCombobox(ttk.Combobox):
     def __init__(self, master: tk.Misc | None = None, **kwargs: Any):
         super().__init__(master, **kwargs)
         self._completion_list: list[str] = []
+        # Voci in minuscolo, calcolate una volta sola in set_completion_list
+        self._lowered: list[str] = []
+        # Ultima ricerca e indici delle voci trovate, per restringere la successiva
+        self._last_query = ""
+        self._last_matches: list[int] = []
         # Vincoliamo l'evento di rilascio del tasto per filtrare le opzioni
         self.bind("<KeyRelease>", self._on_keyrelease)
 
@@ -83,7 +193,10 @@ class AutocompleteCombobox(ttk.Combobox):
         La lista viene ordinata per rendere la ricerca più prevedibile.
         """
         # Copia e ordina le voci per un confronto case-insensitive
-        self._completion_list = sorted(completion_list, key=lambda s: s.lower())
+        self._completion_list = sorted(completion_list, key=str.lower)
+        self._lowered = [s.lower() for s in self._completion_list]
+        self._last_query = ""
+        self._last_matches = list(range(len(self._completion_list)))
         # Aggiorna le opzioni della combobox
         self["values"] = self._completion_list
 
@@ -95,11 +208,20 @@ class AutocompleteCombobox(ttk.Combobox):
         # Testo attualmente digitato
         typed = self.get()
         # Determina le voci che contengono il testo digitato (ignorando il
-        # maiuscolo/minuscolo)
-        if typed:
-            data = [item for item in self._completion_list if typed.lower() in item.lower()]
+        # maiuscolo/minuscolo).  Se il testo estende la ricerca precedente
+        # (l'utente ha aggiunto caratteri) le corrispondenze sono per forza
+        # tra quelle già trovate: si filtra solo quel sottoinsieme
+        query = typed.lower()
+        if not query:
+            matches = list(range(len(self._completion_list)))
+        elif query == self._last_query:
+            matches = self._last_matches
         else:
-            data = self._completion_list
+            lowered = self._lowered
+            candidates = self._last_matches if query.startswith(self._last_query) else range(len(lowered))
+            matches = [i for i in candidates if query in lowered[i]]
+        self._last_query, self._last_matches = query, matches
+        data = [self._completion_list[i] for i in matches]
         # Aggiorna l'elenco delle opzioni mostrate nella combobox
         self["values"] = data
         # Se c'è almeno una voce corrispondente, apri il menu a discesa
@@ -112,6 +234,9 @@ class AutocompleteCombobox(ttk.Combobox):
 class GlocalAiConfrontoGUI:
     """Classe principale per la finestra dell’interfaccia grafica."""
 
+    # Provider LLM selezionabili
+    PROVIDERS = ("openai", "openrouter")
+
     def __init__(self, root: tk.Tk) -> None:
         self.root = root
         self.root.title("Glocal AI Confronto")
@@ -138,15 +263,30 @@ class GlocalAiConfrontoGUI:
         # Creazione interfaccia
         self.create_widgets()
 
+        # Gli elenchi dei modelli degli altri provider vengono scaricati subito
+        # in background: al cambio di provider la lista arriva dalla cache
+        run_async(self.prefetch_models(exclude=self.provider_var.get()))
+
     # ------------------------------------------------------------------
     # Utility: restituisce la lista dei modelli disponibili per un dato
-    # provider. La chiamata può richiedere pochi secondi perché interroga
-    # le API remote di OpenAI o OpenRouter. In caso di errore o di
-    # mancanza delle chiavi API corrispondenti, viene restituita una lista
-    # vuota. Le risposte vengono filtrate per includere solo modelli
-    # compatibili con le chat (id che contengono "gpt" per OpenAI).
-    def fetch_models_for_provider(self, provider: str) -> list[str]:
+    # provider. Se non è in cache la chiamata può richiedere pochi secondi
+    # perché interroga le API remote di OpenAI o OpenRouter: è una
+    # coroutine da eseguire sull'event loop in background (run_async). In
+    # caso di errore o di mancanza delle chiavi API corrispondenti, viene
+    # restituita una lista vuota (non memorizzata in cache).
+    async def fetch_models_async(self, provider: str) -> list[str]:
         provider = provider.lower() if provider else ""
+        models = _cached_models(provider)
+        if models is None:
+            models = await self.download_models(provider)
+            if models:
+                _store_models(provider, models)
+        return models
+
+    # Interroga le API del provider. Le risposte vengono filtrate per
+    # includere solo modelli compatibili con le chat (id che contengono
+    # "gpt" per OpenAI).
+    async def download_models(self, provider: str) -> list[str]:
         # OpenAI: ottieni l'elenco dei modelli tramite l'API ufficiale
         if provider == "openai":
             api_key = os.getenv("OPENAI_API_KEY")
@@ -155,17 +295,12 @@ class GlocalAiConfrontoGUI:
             url = "https://api.openai.com/v1/models"
             headers = {"Authorization": f"Bearer {api_key}"}
             try:
-                resp = requests.get(url, headers=headers, timeout=10)
+                resp = await _get_http_client().get(url, headers=headers)
                 resp.raise_for_status()
-                models = resp.json().get("data", [])
+                models = json_utils.loads(resp.content).get("data", [])
                 # Filtra solo i modelli con id che contengono "gpt" per evitare
                 # embedding e modelli legacy
-                names: list[str] = []
-                for m in models:
-                    model_id = m.get("id", "")
-                    if "gpt" in model_id:
-                        names.append(model_id)
-                return sorted(names)
+                return sorted({m["id"] for m in models if "gpt" in m.get("id", "")})
             except Exception:
                 return []
 
@@ -177,37 +312,42 @@ class GlocalAiConfrontoGUI:
             url = "https://openrouter.ai/api/v1/models"
             headers = {"Authorization": f"Bearer {api_key}"}
             try:
-                resp = requests.get(url, headers=headers, timeout=10)
+                resp = await _get_http_client().get(url, headers=headers)
                 resp.raise_for_status()
-                data = resp.json().get("data", [])
-                names: list[str] = []
-                for m in data:
-                    # Ogni entry può contenere id, canonical_slug o slug
-                    model_id: str | None = None
-                    # Le chiavi possono variare: id, canonical_slug, slug, name
-                    for key in ("id", "canonical_slug", "slug", "name"):
-                        if key in m and m[key]:
-                            model_id = m[key]
-                            break
-                    if model_id:
-                        names.append(str(model_id))
-                return sorted(names)
+                # Catalogo completo (centinaia di modelli): decodificato dai
+                # byte della risposta con json_utils (orjson se disponibile)
+                data = json_utils.loads(resp.content).get("data", [])
+                # Ogni entry ha normalmente "id"; in mancanza si usano
+                # canonical_slug, slug o name
+                ids = (m.get("id") or m.get("canonical_slug") or m.get("slug") or m.get("name") for m in data)
+                return sorted({str(model_id) for model_id in ids if model_id})
             except Exception:
                 return []
         return []
 
-    # Aggiorna l'elenco dei modelli quando cambia il provider.  Questa
-    # funzione avvia un thread per non bloccare la GUI durante la
-    # richiesta di rete e poi aggiorna la combobox con i risultati.
+    async def prefetch_models(self, exclude: str = "") -> None:
+        """Scarica in parallelo gli elenchi dei modelli dei provider, tranne ``exclude``.
+
+        Il provider selezionato viene già caricato da update_model_list; gli
+        elenchi finiscono nella cache dei modelli.
+        """
+        await asyncio.gather(*(self.fetch_models_async(p) for p in self.PROVIDERS if p != exclude))
+
+    # Aggiorna l'elenco dei modelli quando cambia il provider.  La
+    # richiesta di rete viene eseguita sull'event loop in background per
+    # non bloccare la GUI; al termine la combobox viene aggiornata con i
+    # risultati.
     def update_model_list(self) -> None:
         provider = self.provider_var.get()
-        # Esegui la chiamata in un thread separato
-        def worker() -> None:
-            models = self.fetch_models_for_provider(provider)
+
+        def done(future: Future) -> None:
+            models = future.result()
             # Aggiorna la combobox sul thread principale
             def update_ui() -> None:
-                # Memorizza la lista completa dei modelli
+                # Memorizza la lista completa dei modelli (e la versione in
+                # minuscolo usata dal filtro, calcolata una sola volta)
                 self.model_full_list = models
+                self.model_lower_list = [m.lower() for m in models]
                 # Aggiorna la combobox con l'elenco filtrato in base al filtro
                 self.apply_filter_to_models()
                 # Se l'elenco non è vuoto e il valore corrente non è presente,
@@ -220,8 +360,7 @@ class GlocalAiConfrontoGUI:
                 self.root.after(0, update_ui)
             except Exception:
                 pass
-        # Avvia il thread
-        threading.Thread(target=worker, daemon=True).start()
+        run_async(self.fetch_models_async(provider)).add_done_callback(done)
 
     # Callback eseguito quando l'utente cambia provider.  Aggiorna
     # dinamicamente la lista dei modelli.
@@ -238,9 +377,10 @@ class GlocalAiConfrontoGUI:
         disponibile nella lista filtrata, viene selezionato il primo
         modello disponibile (se presente).
         """
+        self._filter_after_id = None
         query = self.filter_var.get().strip().lower()
         if query:
-            filtered = [m for m in self.model_full_list if query in m.lower()]
+            filtered = [m for m, lower in zip(self.model_full_list, self.model_lower_list) if query in lower]
         else:
             filtered = list(self.model_full_list)
         # Aggiorna le opzioni della combobox
@@ -258,8 +398,14 @@ class GlocalAiConfrontoGUI:
                 self.model_var.set("")
 
     def on_filter_changed(self, event: tk.Event | None = None) -> None:
-        """Gestisce l'aggiornamento della lista dei modelli quando cambia il filtro."""
-        self.apply_filter_to_models()
+        """Gestisce l'aggiornamento della lista dei modelli quando cambia il filtro.
+
+        Il filtro viene applicato 150 ms dopo l'ultimo tasto: mentre
+        l'utente digita la lista non viene ricalcolata a ogni carattere.
+        """
+        if self._filter_after_id is not None:
+            self.root.after_cancel(self._filter_after_id)
+        self._filter_after_id = self.root.after(150, self.apply_filter_to_models)
 
     def log(self, message: str) -> None:
         """Aggiunge una riga al log visualizzato nella GUI.
@@ -278,6 +424,26 @@ class GlocalAiConfrontoGUI:
         except Exception:
             pass
 
+    def streaming_progress(self, label: str) -> Callable[[str], None]:
+        """Restituisce una callback che riporta nel log l'avanzamento di una risposta in streaming.
+
+        La callback può essere chiamata da qualunque thread: il log viene
+        aggiornato sul thread di Tk (root.after), al massimo una volta al
+        secondo, con il numero di caratteri ricevuti.
+        """
+        received = 0
+        last_log = time.monotonic()
+
+        def on_chunk(chunk: str) -> None:
+            nonlocal received, last_log
+            received += len(chunk)
+            now = time.monotonic()
+            if now - last_log >= 1.0:
+                last_log = now
+                self.root.after(0, self.log, f"{label}: ricevuti {received} caratteri…")
+
+        return on_chunk
+
     def create_widgets(self) -> None:
         """Crea e dispone i widget dell’interfaccia."""
         # Selettore file
@@ -317,7 +483,7 @@ class GlocalAiConfrontoGUI:
 
         # RIGA 0: Provider e Filtro modello
         ttk.Label(llm_frame, text="Provider:").grid(row=0, column=0, sticky=tk.W, padx=5, pady=5)
-        providers = ["openai", "openrouter"]
+        providers = list(self.PROVIDERS)
         self.provider_combo = ttk.Combobox(
             llm_frame,
             textvariable=self.provider_var,
@@ -354,6 +520,9 @@ class GlocalAiConfrontoGUI:
 
         # Memorizzeremo la lista completa dei modelli restituiti dal provider
         self.model_full_list: list[str] = []
+        self.model_lower_list: list[str] = []
+        # Applicazione del filtro in attesa (debounce di on_filter_changed)
+        self._filter_after_id: str | None = None
         # Carichiamo immediatamente la lista dei modelli per il provider di default
         self.update_model_list()
         # Disabilita opzioni se il metodo non include LLM
@@ -373,12 +542,8 @@ class GlocalAiConfrontoGUI:
         # Frame per i log
         log_frame = ttk.LabelFrame(self.root, text="Log")
         log_frame.pack(fill=tk.BOTH, padx=10, pady=5, expand=True)
-        # Importiamo scrolledtext per avere una scrollbar integrata
-        try:
-            from tkinter import scrolledtext
-            self.log_text: tk.Text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, height=6)
-        except Exception:
-            self.log_text = tk.Text(log_frame, wrap=tk.WORD, height=6)
+        # ScrolledText per avere una scrollbar integrata
+        self.log_text: tk.Text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, height=6)
         self.log_text.pack(fill=tk.BOTH, expand=True)
         self.log_text.config(state=tk.DISABLED)
 
@@ -411,11 +576,12 @@ class GlocalAiConfrontoGUI:
         if not hasattr(self, "action_frame"):
             self.action_frame = ttk.Frame(self.root)
             self.action_frame.pack(fill=tk.X, padx=10, pady=10)
-            ttk.Button(
+            self.start_button = ttk.Button(
                 self.action_frame,
                 text="Avvia estrazione",
                 command=self.run_extraction
-            ).pack(side=tk.LEFT)
+            )
+            self.start_button.pack(side=tk.LEFT)
 
 
     def select_file(self) -> None:
@@ -428,72 +594,115 @@ class GlocalAiConfrontoGUI:
             self.file_path_var.set(file_path)
 
     def run_extraction(self) -> None:
-        """Esegue l’estrazione secondo le opzioni selezionate e salva i risultati su file."""
+        """Avvia l’estrazione secondo le opzioni selezionate e salva i risultati su file.
+
+        L'estrazione viene eseguita in un thread separato per non bloccare
+        l'interfaccia; il pulsante di avvio resta disabilitato fino al
+        termine.
+        """
         file_path = self.file_path_var.get().strip()
         if not file_path or not os.path.isfile(file_path):
             messagebox.showerror("Errore", "Per favore seleziona un file PDF valido.")
             return
         method = self.method_var.get()
+        # Leggi provider e modello selezionati (le variabili Tk vanno lette
+        # sul thread principale)
+        provider = self.provider_var.get().strip() or "openai"
+        model = self.model_var.get().strip() or "gpt-3.5-turbo"
+
+        self.start_button.config(state=tk.DISABLED)
+
+        # Log: inizio estrazione
+        self.log(f"Inizio estrazione per il file: {file_path}")
+
+        # Azzeriamo il costo totale stimato per questa sessione
+        self.total_cost = 0.0
 
+        threading.Thread(
+            target=self.extraction_worker,
+            args=(file_path, method, provider, model),
+            daemon=True,
+        ).start()
+
+    def extraction_worker(self, file_path: str, method: str, provider: str, model: str) -> None:
+        """Esegue le estrazioni richieste (in parallelo) e salva i risultati.
+
+        Document AI e LLM sono chiamate di rete indipendenti: con il metodo
+        "Entrambi" vengono eseguite contemporaneamente e il tempo totale è
+        quello della più lenta.  Gli aggiornamenti dell'interfaccia passano
+        da root.after perché questo metodo non gira sul thread di Tk.
+        """
         # Directory e nome base del file PDF
         directory = os.path.dirname(file_path)
         base_name, _ = os.path.splitext(os.path.basename(file_path))
 
         # Timestamp per i nomi dei file
-        import datetime
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
         saved_files = []
 
-        # Log: inizio estrazione
-        self.log(f"Inizio estrazione per il file: {file_path}")
-
-        # Azzeriamo il costo totale stimato per questa sessione
-        self.total_cost = 0.0
-
-        # Esecuzione Document AI e salvataggio
-        if method in ("google", "both"):
-            try:
-                result = extract_with_google_document_ai(file_path)
-                out_name = f"{base_name}_google_{timestamp}.json"
-                out_path = os.path.join(directory, out_name)
-                with open(out_path, "w", encoding="utf-8") as f:
-                    json.dump(result, f, ensure_ascii=False, indent=2)
-                saved_files.append(out_path)
-                # Log
-                self.log(f"Document AI completato: file salvato come {out_name}")
-                # Aggiorna il costo (placeholder: costo non calcolato)
-                # In futuro si potrà calcolare il costo in base alle API
-                # Document AI. Al momento viene aggiunto zero.
-                self.total_cost += 0.0
-            except Exception as e:
-                messagebox.showerror("Errore Document AI", f"Errore durante l'estrazione con Document AI:\n{e}")
-                self.log(f"Errore Document AI: {e}")
-
-        # Esecuzione ChatGPT/LLM e salvataggio
-        if method in ("chatgpt", "both"):
-            try:
-                # Leggi provider e modello selezionati
-                provider = self.provider_var.get().strip() or "openai"
-                model = self.model_var.get().strip() or "gpt-3.5-turbo"
-                result = extract_with_chatgpt(file_path, model=model, provider=provider)
-                # Genera un nome file che includa provider e modello per distinguere l'LLM utilizzato
-                provider_clean = provider.replace(" ", "-") if provider else "llm"
-                model_clean = model.replace(" ", "-") if model else "model"
-                out_name = f"{base_name}_{provider_clean}_{model_clean}_{timestamp}.json"
-                out_path = os.path.join(directory, out_name)
-                with open(out_path, "w", encoding="utf-8") as f:
-                    json.dump(result, f, ensure_ascii=False, indent=2)
-                saved_files.append(out_path)
-                # Log
-                self.log(f"LLM completato ({provider}/{model}): file salvato come {out_name}")
-                # Aggiorna il costo stimato (placeholder a 0).  Se in futuro si
-                # desidera calcolare il costo in base ai token utilizzati
-                # dall'LLM, si potrà aggiornare questa linea.
-                self.total_cost += 0.0
-            except Exception as e:
-                messagebox.showerror("Errore ChatGPT", f"Errore durante l'estrazione con il LLM:\n{e}")
-                self.log(f"Errore LLM: {e}")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {}
+            # Esecuzione Document AI
+            if method in ("google", "both"):
+                futures[executor.submit(extract_with_google_document_ai, file_path)] = "google"
+            # Esecuzione ChatGPT/LLM: la risposta arriva in streaming e il
+            # log mostra l'avanzamento
+            if method in ("chatgpt", "both"):
+                futures[executor.submit(
+                    extract_with_chatgpt, file_path, model=model, provider=provider,
+                    on_chunk=self.streaming_progress(f"LLM ({provider}/{model})"),
+                    on_provider=lambda served_by: self.root.after(
+                        0, self.log, f"LLM ({provider}/{model}): servito da {served_by}"),
+                )] = "chatgpt"
+
+            # Salvataggio dei risultati man mano che le estrazioni terminano
+            for future in as_completed(futures):
+                if futures[future] == "google":
+                    try:
+                        result = future.result()
+                        out_name = f"{base_name}_google_{timestamp}.json"
+                        out_path = os.path.join(directory, out_name)
+                        with open(out_path, "wb") as f:
+                            json_utils.dump(result, f, indent=True)
+                        saved_files.append(out_path)
+                        # Log
+                        self.root.after(0, self.log, f"Document AI completato: file salvato come {out_name}")
+                        # Aggiorna il costo (placeholder: costo non calcolato)
+                        # In futuro si potrà calcolare il costo in base alle API
+                        # Document AI. Al momento viene aggiunto zero.
+                        self.total_cost += 0.0
+                    except Exception as e:
+                        self.root.after(0, messagebox.showerror, "Errore Document AI",
+                                        f"Errore durante l'estrazione con Document AI:\n{e}")
+                        self.root.after(0, self.log, f"Errore Document AI: {e}")
+                else:
+                    try:
+                        result = future.result()
+                        # Genera un nome file che includa provider e modello per distinguere l'LLM utilizzato
+                        provider_clean = provider.replace(" ", "-") if provider else "llm"
+                        model_clean = model.replace(" ", "-") if model else "model"
+                        out_name = f"{base_name}_{provider_clean}_{model_clean}_{timestamp}.json"
+                        out_path = os.path.join(directory, out_name)
+                        with open(out_path, "wb") as f:
+                            json_utils.dump(result, f, indent=True)
+                        saved_files.append(out_path)
+                        # Log
+                        self.root.after(0, self.log, f"LLM completato ({provider}/{model}): file salvato come {out_name}")
+                        # Aggiorna il costo stimato (placeholder a 0).  Se in futuro si
+                        # desidera calcolare il costo in base ai token utilizzati
+                        # dall'LLM, si potrà aggiornare questa linea.
+                        self.total_cost += 0.0
+                    except Exception as e:
+                        self.root.after(0, messagebox.showerror, "Errore ChatGPT",
+                                        f"Errore durante l'estrazione con il LLM:\n{e}")
+                        self.root.after(0, self.log, f"Errore LLM: {e}")
+
+        self.root.after(0, self.extraction_done, saved_files, directory)
+
+    def extraction_done(self, saved_files: list[str], directory: str) -> None:
+        """Conclude l'estrazione sul thread di Tk: riepilogo, cartella di destinazione e costi."""
+        self.start_button.config(state=tk.NORMAL)
 
         if saved_files:
             # Log file salvati
@@ -503,8 +712,6 @@ class GlocalAiConfrontoGUI:
             # Apri la cartella di destinazione nel file manager
             folder = directory
             try:
-                import sys
-                import subprocess
                 if sys.platform.startswith("win"):  # Windows
                     os.startfile(folder)
                 elif sys.platform == "darwin":  # macOS
@@ -563,6 +770,12 @@ def main() -> None:
     root = tk.Tk()
     app = GlocalAiConfrontoGUI(root)
     root.mainloop()
+    # Chiude le connessioni HTTP rimaste aperte sull'event loop in background
+    if _loop is not None:
+        try:
+            run_async(_close_http_client()).result(timeout=5)
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":
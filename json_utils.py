@@ -0,0 +1,72 @@
+"""
+json_utils.py
+=============
+
+Serializzazione JSON veloce con ``orjson`` quando il pacchetto è
+installato, con ripiego automatico sul modulo ``json`` della libreria
+standard.  Le funzioni lavorano con ``bytes`` (UTF-8, caratteri non ASCII
+non escapati) così l'output può essere scritto direttamente su file
+aperti in modalità binaria.
+"""
+
+import json
+from typing import Any, BinaryIO, Iterable, Iterator, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # orjson è opzionale
+    orjson = None
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serializza ``obj`` in JSON (bytes UTF-8), indentato di 2 spazi se richiesto."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def dump(obj: Any, fp: BinaryIO, indent: bool = False) -> None:
+    """Scrive ``obj`` in JSON sul file binario ``fp``."""
+    fp.write(dumps(obj, indent=indent))
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Decodifica un documento JSON da bytes o stringa."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_stream(items: Iterable[Tuple[str, Any]], fp: BinaryIO, indent: bool = False) -> None:
+    """
+    Scrive un oggetto JSON una coppia (chiave, valore) alla volta, senza
+    costruire in memoria l'intero documento.  Se un valore è un iteratore
+    (es. un generatore) viene scritto come array, un elemento alla volta.
+    """
+    nl = b"\n" if indent else b""
+    sep = b": " if indent else b":"
+
+    def encode(value: Any, level: int) -> bytes:
+        data = dumps(value, indent=indent)
+        # Nel JSON i ritorni a capo dentro le stringhe sono escapati: gli unici
+        # "\n" sono quelli dell'indentazione, che va spostata al livello corrente
+        return data.replace(b"\n", b"\n" + b"  " * level) if indent else data
+
+    fp.write(b"{")
+    empty = True
+    for key, value in items:
+        fp.write((b"" if empty else b",") + nl + b"  " * indent + dumps(str(key)) + sep)
+        empty = False
+        if isinstance(value, Iterator):
+            fp.write(b"[")
+            first = True
+            for item in value:
+                fp.write((b"" if first else b",") + nl + b"    " * indent + encode(item, 2))
+                first = False
+            fp.write(b"]" if first else nl + b"  " * indent + b"]")
+        else:
+            fp.write(encode(value, 1))
+    fp.write(b"}" if empty else nl + b"}")
@@ -1,19 +1,37 @@
 import os
-import json
+import asyncio
 import logging
-from json_repair import loads as jr_loads, repair_json as jr_repair
-from langchain.chains import LLMChain
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, List, Optional
+from json_repair import loads as jr_loads
 from langchain.prompts import PromptTemplate
 from langchain_community.chat_models import ChatOpenAI
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
 from dotenv import load_dotenv
+from openai import BadRequestError
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+import extraction_cache
+import json_utils
+from rate_limit import llm_limit
 
 logging.basicConfig(level=logging.INFO)
-load_dotenv()
+# Il .env viene letto una volta sola: i processi figli (es. i worker della
+# pipeline) ereditano l'ambiente già caricato e non lo rileggono
+if os.getenv("_DOTENV_LOADED") != "1":
+    load_dotenv()
+    os.environ["_DOTENV_LOADED"] = "1"
+
+# Versione del prompt: va incrementata a ogni modifica del template, così
+# da invalidare i risultati salvati nella cache di estrazione.
+PROMPT_VERSION = "3"
 
-def extract_data_from_text(text: str, model_name: str = "gpt-3.5-turbo", provider: str = "openai") -> dict:
-    prompt = PromptTemplate(
-        input_variables=["input"],
-        template="""
+# Template del prompt, costruito una sola volta all'import del modulo
+PROMPT = PromptTemplate(
+    input_variables=["input"],
+    template="""
 You are a highly accurate data extractor specialized in Delivery Notes (Documenti di Trasporto - DDT).
 You will receive raw text extracted from a PDF file (possibly OCR). Your task is to extract and structure the information in the exact JSON format shown below.
 
@@ -55,50 +73,433 @@ JSON structure:
 Text to process:
 {input}
 """
-    )
+)
+
+# Limite facoltativo dei token generati dal modello (LLM_MAX_TOKENS); se non
+# impostato decide il provider.  Un limite troppo basso tronca i documenti
+# con molte righe.
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "0")) or None
+# Richieste contemporanee al massimo per extract_data_from_texts, per
+# provider: OpenRouter ha limiti per chiave più bassi
+LLM_MAX_CONCURRENCY = {
+    "openai": int(os.getenv("LLM_MAX_CONCURRENCY_OPENAI", "8")),
+    "openrouter": int(os.getenv("LLM_MAX_CONCURRENCY_OPENROUTER", "4")),
+}
+# Nuovi tentativi del client OpenAI sugli errori transitori (429 compresi),
+# con backoff esponenziale e rispetto di Retry-After
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+# Documenti con almeno LLM_PAGE_SPLIT pagine vengono estratti una pagina per
+# richiesta, in parallelo (0 = disattivato: una sola richiesta per documento)
+LLM_PAGE_SPLIT = int(os.getenv("LLM_PAGE_SPLIT", "0"))
+# Limite facoltativo dei token del testo inviato al modello (0 = nessun limite)
+LLM_MAX_INPUT_TOKENS = int(os.getenv("LLM_MAX_INPUT_TOKENS", "0"))
+
+try:
+    # Opzionale: conteggio esatto dei token per LLM_MAX_INPUT_TOKENS
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _prepara_testo(text: str) -> str:
+    """Riduce il testo OCR prima di inserirlo nel prompt.
+
+    Gli spazi ripetuti di ogni riga diventano uno solo e le righe vuote
+    vengono eliminate (ogni spazio costa token senza aggiungere
+    informazione); nessuna riga con testo viene scartata.  Con
+    ``LLM_MAX_INPUT_TOKENS`` il testo viene troncato all'ultima riga
+    completa entro il limite (senza tiktoken si stimano 4 caratteri per
+    token).
+    """
+    text = "\n".join(" ".join(words) for words in map(str.split, text.splitlines()) if words)
+    if LLM_MAX_INPUT_TOKENS <= 0:
+        return text
+    if tiktoken is not None:
+        tokens = _encoding().encode(text)
+        if len(tokens) <= LLM_MAX_INPUT_TOKENS:
+            return text
+        truncated = _encoding().decode(tokens[:LLM_MAX_INPUT_TOKENS])
+    else:
+        if len(text) <= LLM_MAX_INPUT_TOKENS * 4:
+            return text
+        truncated = text[:LLM_MAX_INPUT_TOKENS * 4]
+    return truncated.rsplit("\n", 1)[0] if "\n" in truncated else truncated
+
+
+class _Riga(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    progressivo_riga: Optional[str]
+    riferimento: Optional[str]
+    codice_articolo: Optional[str]
+    descrizione: Optional[str]
+    quantità: Optional[float]
+    prezzo: Optional[float]
+
+
+class _Documento(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    fornitore: Optional[str]
+    numero_documento: Optional[str]
+    data_documento: Optional[str]
+    riga: List[_Riga]
+
+
+# Structured output di OpenAI: la risposta rispetta lo schema del documento
+_JSON_SCHEMA_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "documento", "strict": True, "schema": _Documento.model_json_schema()},
+}
+# Modelli OpenAI che hanno rifiutato lo schema (es. gpt-3.5-turbo): per
+# questi si usa la modalità JSON semplice
+_SENZA_SCHEMA = set()
+
+
+def _usa_schema(provider: str, model_name: str) -> bool:
+    return provider == "openai" and model_name not in _SENZA_SCHEMA
+
 
+def _errore_schema(exc: BadRequestError) -> bool:
+    """True se l'errore 400 riguarda il formato di risposta (schema non supportato dal modello)."""
+    testo = f"{getattr(exc, 'code', '') or ''} {exc}".lower()
+    return "response_format" in testo or "json_schema" in testo
+
+
+def _disattiva_schema(provider: str, model_name: str, exc: BadRequestError) -> bool:
+    """Dopo un errore 400 dovuto allo schema: lo disattiva per il modello e restituisce True.
+
+    Gli altri errori 400 (es. contesto troppo lungo) non cambiano la
+    modalità di risposta e vanno propagati.
+    """
+    if not _usa_schema(provider, model_name) or not _errore_schema(exc):
+        return False
+    logging.warning("Structured output non supportato da %s, uso la modalità JSON", model_name)
+    _SENZA_SCHEMA.add(model_name)
+    return True
+
+
+@lru_cache(maxsize=32)
+def _get_llm(provider: str, model_name: str, json_schema: bool = False) -> ChatOpenAI:
+    """Restituisce il modello per ``provider``/``model_name``, creato una sola volta.
+
+    L'istanza (e il relativo client HTTP con le connessioni aperte) viene
+    riusata da tutte le estrazioni successive.  La risposta è vincolata
+    allo schema del documento (``json_schema``) oppure, per i modelli che
+    non lo supportano, alla modalità JSON (``json_object``).
+    """
+    response_format = _JSON_SCHEMA_FORMAT if json_schema else {"type": "json_object"}
+    model_kwargs = {"response_format": response_format}
     if provider == "openai":
-        llm = ChatOpenAI(model_name=model_name, temperature=0)
-    elif provider == "openrouter":
-        llm = ChatOpenAI(
+        return ChatOpenAI(model_name=model_name, temperature=0, max_tokens=LLM_MAX_TOKENS,
+                          max_retries=LLM_MAX_RETRIES, model_kwargs=model_kwargs)
+    if provider == "openrouter":
+        return ChatOpenAI(
             model_name=model_name,
             temperature=0,
+            max_tokens=LLM_MAX_TOKENS,
+            max_retries=LLM_MAX_RETRIES,
             openai_api_base="https://openrouter.ai/api/v1",
-            openai_api_key=os.getenv("OPENROUTER_API_KEY")
+            openai_api_key=os.getenv("OPENROUTER_API_KEY"),
+            # Provider ordinati per latenza, con passaggio automatico al
+            # successivo se quello scelto è degradato
+            model_kwargs={**model_kwargs,
+                          "extra_body": {"provider": {"allow_fallbacks": True, "sort": "latency"}}},
         )
-    else:
-        raise ValueError(f"Provider '{provider}' non supportato.")
+    raise ValueError(f"Provider '{provider}' non supportato.")
+
+
+def _build_chain(model_name: str, provider: str) -> Runnable:
+    """Costruisce la catena prompt → LLM → testo della risposta per il provider indicato.
+
+    Composizione LCEL diretta (``prompt | llm | StrOutputParser()``) al
+    posto del deprecato ``LLMChain`` e dei suoi livelli intermedi.
+    """
+    return _get_chain(provider, model_name, _usa_schema(provider, model_name))
+
+
+@lru_cache(maxsize=32)
+def _get_chain(provider: str, model_name: str, json_schema: bool) -> Runnable:
+    """Catena per provider/modello/modalità di risposta, composta una sola volta."""
+    return PROMPT | _get_llm(provider, model_name, json_schema) | StrOutputParser()
+
+
+def _text_cache_key(text: str, model_name: str, provider: str) -> str:
+    """Chiave di cache per il risultato dell'LLM su ``text`` (hash del testo + configurazione)."""
+    return extraction_cache.make_key(
+        "llm_text", provider, model_name, PROMPT_VERSION, str(LLM_MAX_TOKENS),
+        extraction_cache.content_hash(text.encode("utf-8")),
+    )
+
+
+class _RigheIncrementali:
+    """Estrae le righe complete dell'array ``"riga"`` da una risposta JSON ricevuta a pezzi.
+
+    Tiene traccia di stringhe e annidamento carattere per carattere: ogni
+    oggetto riga viene decodificato appena si chiude la sua parentesi,
+    senza attendere il resto della risposta.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._str: List[str] = []
+        self._key = None
+        self._in_rows = False
+        self._obj: Optional[List[str]] = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        rows = []
+        for ch in chunk:
+            if self._obj is not None:
+                self._obj.append(ch)
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        self._key = "".join(self._str)
+                elif self._depth == 1:
+                    self._str.append(ch)
+                continue
+            if ch == '"':
+                self._in_str = True
+                self._str = []
+            elif ch == "{" or ch == "[":
+                if ch == "[" and self._depth == 1 and self._key == "riga":
+                    self._in_rows = True
+                elif ch == "{" and self._in_rows and self._depth == 2:
+                    self._obj = [ch]
+                self._depth += 1
+            elif ch == "}" or ch == "]":
+                self._depth -= 1
+                if self._obj is not None and self._depth == 2:
+                    try:
+                        rows.append(json_utils.loads("".join(self._obj)))
+                    except ValueError:
+                        pass
+                    self._obj = None
+                elif self._in_rows and self._depth == 1:
+                    self._in_rows = False
+        return rows
 
-    chain = LLMChain(llm=llm, prompt=prompt)
+
+def _invoke(chain: Runnable, text: str, on_row: Optional[Callable[[dict], None]]) -> str:
+    """Esegue la catena; con ``on_row`` riceve la risposta in streaming e passa ogni riga appena completa."""
+    if on_row is None:
+        return chain.invoke({"input": text})
+    righe = _RigheIncrementali()
+    parts = []
+    for chunk in chain.stream({"input": text}):
+        parts.append(chunk)
+        for row in righe.feed(chunk):
+            on_row(row)
+    return "".join(parts)
+
+
+def extract_data_from_text(text: str, model_name: str = "gpt-3.5-turbo", provider: str = "openai",
+                           on_row: Optional[Callable[[dict], None]] = None) -> dict:
+    """Estrae i dati strutturati dal testo OCR di un documento.
+
+    Con ``on_row`` la risposta del modello viene ricevuta in streaming e la
+    callback è chiamata con ogni riga del documento appena è completa (es.
+    per salvarla senza attendere la fine della risposta); il valore
+    restituito è comunque il documento completo.
+    """
+    text = _prepara_testo(text)
+    # Stesso testo con la stessa configurazione: risultato dalla cache, senza chiamare il modello
+    key = _text_cache_key(text, model_name, provider)
+    cached = extraction_cache.get(key)
+    if isinstance(cached, dict):
+        if on_row is not None:
+            for row in cached.get("riga") or []:
+                on_row(row)
+        return cached
 
     try:
-        response = chain.run({"input": text})
+        # Limite di richieste al secondo verso il provider (LLM_RATE_LIMIT)
+        with llm_limit:
+            try:
+                response = _invoke(_build_chain(model_name, provider), text, on_row)
+            except BadRequestError as exc:
+                if not _disattiva_schema(provider, model_name, exc):
+                    raise
+                response = _invoke(_build_chain(model_name, provider), text, on_row)
     except Exception as exc:
-        logging.error("LLM error during run(): %s", exc, exc_info=True)
+        logging.error("LLM error during invoke(): %s", exc, exc_info=True)
         raise RuntimeError(f"Errore chiamata LLM: {exc}")
 
-    logging.info("LLM raw response:\n%s", response)
+    return _store(key, _parse_response(response, _usa_schema(provider, model_name)))
+
+
+async def aextract_data_from_text(text: str, model_name: str = "gpt-3.5-turbo", provider: str = "openai") -> dict:
+    """Versione asincrona di ``extract_data_from_text``.
+
+    L'attesa della risposta del modello non blocca l'event loop: più
+    estrazioni (o altre chiamate di rete) possono procedere in parallelo
+    con ``asyncio.gather``.
+    """
+    text = _prepara_testo(text)
+    key = _text_cache_key(text, model_name, provider)
+    cached = extraction_cache.get(key)
+    if isinstance(cached, dict):
+        return cached
 
-    # Primo tentativo di parsing
     try:
-        return json.loads(response)
-    except json.JSONDecodeError as e:
-        logging.warning("json.loads failed: %s", e)
+        async with llm_limit:
+            try:
+                response = await _build_chain(model_name, provider).ainvoke({"input": text})
+            except BadRequestError as exc:
+                if not _disattiva_schema(provider, model_name, exc):
+                    raise
+                response = await _build_chain(model_name, provider).ainvoke({"input": text})
+    except Exception as exc:
+        logging.error("LLM error during ainvoke(): %s", exc, exc_info=True)
+        raise RuntimeError(f"Errore chiamata LLM: {exc}")
+
+    return _store(key, _parse_response(response, _usa_schema(provider, model_name)))
+
+
+def _store(key: str, result: dict) -> dict:
+    """Salva in cache il risultato (solo se è un oggetto JSON) e lo restituisce."""
+    if isinstance(result, dict):
+        extraction_cache.set(key, result)
+    return result
+
+
+async def aextract_data_from_texts(texts: List[str], model_name: str = "gpt-3.5-turbo",
+                                   provider: str = "openai") -> List[dict]:
+    """Estrae i dati da più testi con richieste al modello in parallelo.
+
+    Al massimo ``LLM_MAX_CONCURRENCY[provider]`` richieste sono in corso
+    contemporaneamente (oltre al limite di LLM_RATE_LIMIT).  I risultati
+    sono nello stesso ordine di ``texts``; se un'estrazione fallisce viene
+    sollevata la sua eccezione.
+    """
+    # Il semaforo è creato per ogni chiamata: resta legato all'event loop corrente
+    sem = asyncio.Semaphore(LLM_MAX_CONCURRENCY.get(provider, 4))
+
+    async def estrai(text: str) -> dict:
+        async with sem:
+            return await aextract_data_from_text(text, model_name=model_name, provider=provider)
+
+    return list(await asyncio.gather(*(estrai(text) for text in texts)))
+
+
+def extract_data_from_texts(texts: List[str], model_name: str = "gpt-3.5-turbo",
+                            provider: str = "openai") -> List[dict]:
+    """Versione sincrona di ``aextract_data_from_texts``, con le richieste in parallelo su thread.
 
-    # Fallback con json-repair.loads
+    Usa il client sincrono del modello: quello asincrono dell'istanza
+    memorizzata da ``_get_llm`` resta legato al primo event loop, per cui
+    un ``asyncio.run`` per ogni chiamata fallirebbe dalla seconda in poi
+    ("Event loop is closed").
+    """
+    workers = max(1, min(LLM_MAX_CONCURRENCY.get(provider, 4), len(texts)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(
+            lambda text: extract_data_from_text(text, model_name=model_name, provider=provider), texts
+        ))
+
+
+def _unisci_pagine(results: List[dict]) -> dict:
+    """Unisce i risultati estratti pagina per pagina in un unico documento.
+
+    I campi di testata vengono presi dalla prima pagina che li riporta; le
+    righe sono concatenate e rinumerate.  Le prime righe di una pagina senza
+    "riferimento" ereditano l'ultimo riferimento della pagina precedente,
+    come prevede il prompt per i riferimenti indicati una volta per gruppo.
+    """
+    merged = {"fornitore": None, "numero_documento": None, "data_documento": None, "riga": []}
+    riferimento = None
+    for result in results:
+        for field in ("fornitore", "numero_documento", "data_documento"):
+            if not merged[field] and result.get(field):
+                merged[field] = result[field]
+        eredita = True
+        for row in result.get("riga") or []:
+            if not isinstance(row, dict):
+                continue
+            row = dict(row)
+            if row.get("riferimento"):
+                eredita = False
+                riferimento = row["riferimento"]
+            elif eredita and riferimento:
+                row["riferimento"] = riferimento
+            merged["riga"].append(row)
+    for i, row in enumerate(merged["riga"], 1):
+        row["progressivo_riga"] = str(i)
+    return merged
+
+
+def _pagine(text: str) -> List[str]:
+    """Pagine del testo OCR da estrarre separatamente; lista vuota se basta una sola richiesta."""
+    if not LLM_PAGE_SPLIT:
+        return []
+    pages = [page for page in text.split("\f") if page.strip()]
+    return pages if len(pages) >= max(LLM_PAGE_SPLIT, 2) else []
+
+
+async def aextract_data_by_page(text: str, model_name: str = "gpt-3.5-turbo",
+                                provider: str = "openai") -> dict:
+    """Estrae i dati da un documento, una richiesta per pagina se è abbastanza lungo.
+
+    Le pagine sono separate dal carattere di fine pagina (``\\f``) prodotto
+    dall'OCR.  Con almeno ``LLM_PAGE_SPLIT`` pagine le richieste partono in
+    parallelo (``aextract_data_from_texts``) e il tempo totale è quello della
+    pagina più lenta; altrimenti si usa una sola richiesta.
+    """
+    pages = _pagine(text)
+    if not pages:
+        return await aextract_data_from_text(text, model_name=model_name, provider=provider)
+    results = await aextract_data_from_texts(pages, model_name=model_name, provider=provider)
+    return _unisci_pagine(results)
+
+
+def extract_data_by_page(text: str, model_name: str = "gpt-3.5-turbo", provider: str = "openai") -> dict:
+    """Versione sincrona di ``aextract_data_by_page``: le pagine sono estratte in parallelo su thread."""
+    pages = _pagine(text)
+    if not pages:
+        return extract_data_from_text(text, model_name=model_name, provider=provider)
+    return _unisci_pagine(extract_data_from_texts(pages, model_name=model_name, provider=provider))
+
+
+def _parse_response(response: str, schema: bool = False) -> dict:
+    """Decodifica la risposta del modello, riparando il JSON se necessario.
+
+    Con ``schema`` (structured output) la risposta viene validata
+    direttamente con il modello del documento, senza passare dai tentativi
+    di riparazione; questi restano solo per le risposte non conformi (es.
+    troncate da LLM_MAX_TOKENS).
+    """
+    logging.info("LLM raw response:\n%s", response)
+
+    if schema:
+        try:
+            return _Documento.model_validate_json(response).model_dump()
+        except ValidationError as e:
+            logging.warning("Risposta non conforme allo schema: %s", e)
+
+    # Primo tentativo di parsing (orjson se installato); gli errori di
+    # decodifica di json e orjson sono entrambi ValueError
     try:
-        repaired = jr_loads(response)
-        logging.info("json-repair.loads succeeded")
-        return repaired
-    except Exception as e:
-        logging.warning("json-repair.loads failed: %s", e)
+        return json_utils.loads(response)
+    except ValueError as e:
+        logging.warning("json_utils.loads failed: %s", e)
 
-    # Secondo fallback con json-repair.repair_json
+    # Unico fallback: json-repair.loads ripara e decodifica in un solo
+    # passaggio (è repair_json con return_objects=True)
     try:
-        fixed = jr_repair(response, return_objects=True)
-        logging.info("json-repair.repair_json succeeded")
-        return fixed
+        repaired = jr_loads(response)
     except Exception as e:
-        logging.error("json-repair.repair_json also failed: %s", e)
-
-    raise RuntimeError("Parsing JSON fallito anche dopo i tentativi di riparazione.")
+        logging.error("json-repair.loads failed: %s", e)
+        raise RuntimeError("Parsing JSON fallito anche dopo il tentativo di riparazione.") from e
+    logging.info("json-repair.loads succeeded")
+    return repaired
@@ -1,10 +1,11 @@
 # main.py
 import argparse
+import asyncio
 import uvicorn
 import os
 import time
 from api import app
-from db_data import record_data, get_status_by_recid, update_status, save_extraction_results
+from db_data import record_data, get_status_by_recid, update_status, save_and_complete
 from data_utils import extract_data_from_file
 from dotenv import load_dotenv
 import logging
@@ -13,6 +14,60 @@ import os
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
+# Pipeline su più file: documenti OCR in attesa dell'LLM al massimo
+# (contropressione) e richieste LLM contemporanee
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+PIPELINE_LLM_WORKERS = int(os.getenv("PIPELINE_LLM_WORKERS", "4"))
+
+
+async def run_pipeline_batch(paths, prompt=None, model="gpt-3.5-turbo", provider="openai"):
+    """Elabora più PDF come pipeline produttore/consumatori.
+
+    Un produttore registra ogni file ed esegue l'OCR (già parallelo sulle
+    pagine) in un thread; PIPELINE_LLM_WORKERS consumatori inviano i testi
+    al modello e salvano i risultati.  La coda limitata a
+    PIPELINE_QUEUE_SIZE documenti ferma l'OCR se l'LLM resta indietro, così
+    i testi in memoria non crescono senza limite; il tempo totale dipende
+    dalla fase più lenta invece che dalla somma delle due.
+    Restituisce i RecID nell'ordine dei file.
+    """
+    from pdf_reader import extract_text_from_pdf
+    from llm_agent import aextract_data_by_page
+
+    queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    recids = []
+
+    async def ocr_producer():
+        for path in paths:
+            recid, _ = await asyncio.to_thread(
+                record_data, path, os.path.basename(path), prompt, initial_status=2
+            )
+            recids.append(recid)
+            try:
+                text = await asyncio.to_thread(extract_text_from_pdf, path)
+            except Exception as e:
+                logging.error(f"Errore OCR per RecId {recid}: {e}")
+                await asyncio.to_thread(update_status, recid, 98)  # "Errore"
+                continue
+            await queue.put((recid, text))
+        # Un segnale di fine per ogni consumatore
+        for _ in range(PIPELINE_LLM_WORKERS):
+            await queue.put(None)
+
+    async def llm_consumer():
+        while (item := await queue.get()) is not None:
+            recid, text = item
+            try:
+                data = await aextract_data_by_page(text, model_name=model, provider=provider)
+                await asyncio.to_thread(save_and_complete, recid, text, data, 4)
+                logging.info(f"Pipeline completata - RecID: {recid}")
+            except Exception as e:
+                logging.error(f"Errore LLM per RecId {recid}: {e}")
+                await asyncio.to_thread(update_status, recid, 98)  # "Errore"
+
+    await asyncio.gather(ocr_producer(), *(llm_consumer() for _ in range(PIPELINE_LLM_WORKERS)))
+    return recids
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Interfaccia CLI per elaborazione documenti")
     
@@ -22,29 +77,40 @@ if __name__ == "__main__":
     parser.add_argument("user_prompt", nargs="?", help="Prompt da usare per l'elaborazione")
     
     # New pipeline execution flags
-    parser.add_argument("--pipeline-file", help="Esegui pipeline con file")
+    parser.add_argument("--pipeline-file", nargs="+",
+                        help="Esegui pipeline con uno o più file (più file: OCR e LLM in pipeline)")
     parser.add_argument("--pipeline-prompt", help="Prompt per pipeline")
     
     args = parser.parse_args()
     
-    if args.pipeline_file or args.pipeline_prompt:
+    if args.pipeline_file and len(args.pipeline_file) > 1:
+        # Più file: OCR e LLM procedono in pipeline
+        try:
+            recids = asyncio.run(run_pipeline_batch(args.pipeline_file, args.pipeline_prompt))
+            print({"status": "success", "recids": recids})
+        except Exception as e:
+            logging.error(f"Errore pipeline: {e}")
+
+    elif args.pipeline_file or args.pipeline_prompt:
         # Pipeline execution mode
-        from db_data import record_data, update_status, save_extraction_results
+        from db_data import record_data, update_status, save_and_complete
         from data_utils import extract_data_from_file
         
         try:
+            pipeline_file = args.pipeline_file[0] if args.pipeline_file else None
             recid, status = record_data(
-                args.pipeline_file,
-                os.path.basename(args.pipeline_file) if args.pipeline_file else None,
-                args.pipeline_prompt
+                pipeline_file,
+                os.path.basename(pipeline_file) if pipeline_file else None,
+                args.pipeline_prompt,
+                initial_status=2  # "In elaborazione": si parte subito
             )
             
             # Process synchronously for CLI
-            update_status(recid, 2)
-            if args.pipeline_file:
-                result = extract_data_from_file(args.pipeline_file, "gpt-3.5-turbo", "openai")
-                save_extraction_results(recid, result["text"], result["data"])
-            update_status(recid, 4)
+            if pipeline_file:
+                result = extract_data_from_file(pipeline_file, "gpt-3.5-turbo", "openai")
+                save_and_complete(recid, result["text"], result["data"], 4)
+            else:
+                update_status(recid, 4)
             
             print(f"Pipeline completata - RecID: {recid}")
             print({"status": "success", "recid": recid, "db_status": status})
@@ -1,7 +1,15 @@
-from pdf2image import convert_from_path
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, List
+
+from pdf2image import convert_from_bytes, convert_from_path
 import pytesseract
 import os
 
+import extraction_cache
+
 
 import platform
 import pytesseract
@@ -10,17 +18,122 @@ import pytesseract
 if platform.system() == "Windows":
     pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
+# Pagine elaborate in parallelo.  pytesseract avvia un processo tesseract
+# per pagina: i thread restano in attesa del processo senza trattenere il GIL
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))
+if OCR_WORKERS > 1:
+    # Un thread OpenMP per processo tesseract: con più pagine in parallelo
+    # i thread interni si contenderebbero gli stessi core
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+# Risoluzione di rasterizzazione: 200 dpi bastano per il testo dei DDT e
+# riducono i pixel (e il tempo di tesseract) di oltre la metà rispetto a 300
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+# Binarizzazione (soglia di Otsu) delle pagine prima dell'OCR
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "1") != "0"
+
+try:
+    # Opzionale: tesseract nello stesso processo, senza avviare un
+    # eseguibile (e ricaricare il modello) per ogni pagina
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    # Opzionale: rasterizzazione nello stesso processo con PDFium, senza
+    # avviare poppler (pdftoppm) né passare le pagine da file temporanei
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Istanze tesserocr inizializzate e libere, riusate tra pagine e documenti
+_tess_apis = queue.SimpleQueue()
+
+
+def _convert_pdfium(source, dpi: int, grayscale: bool = False, **_poppler_options) -> List:
+    """Come ``convert_from_path``/``convert_from_bytes``, ma con pypdfium2.
+
+    ``source`` è un percorso o il contenuto del PDF.  PDFium non è
+    thread-safe: le pagine sono rasterizzate una alla volta (l'OCR resta
+    parallelo).  Le opzioni specifiche di poppler vengono ignorate.
+    """
+    pdf = pdfium.PdfDocument(source)
+    try:
+        return [pdf[i].render(scale=dpi / 72, grayscale=grayscale).to_pil() for i in range(len(pdf))]
+    finally:
+        pdf.close()
+
+
+def _soglia_otsu(hist: List[int]) -> int:
+    """Soglia di Otsu per un istogramma a 256 livelli di grigio."""
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    w_back = sum_back = 0
+    best, threshold = 0.0, 127
+    for t, h in enumerate(hist):
+        w_back += h
+        w_fore = total - w_back
+        if not w_back:
+            continue
+        if not w_fore:
+            break
+        sum_back += t * h
+        diff = sum_back / w_back - (sum_all - sum_back) / w_fore
+        between = w_back * w_fore * diff * diff
+        if between > best:
+            best, threshold = between, t
+    return threshold
+
+
+def _binarizza(img):
+    """Converte la pagina in bianco/nero: tesseract lavora più in fretta su un'immagine già pulita."""
+    if img.mode != "L":
+        img = img.convert("L")
+    t = _soglia_otsu(img.histogram())
+    return img.point([255 if p > t else 0 for p in range(256)])
+
+
+def _ocr_image(img) -> str:
+    """OCR di una pagina: con tesserocr riusa un motore già inizializzato, altrimenti pytesseract.
+
+    Se il motore tesserocr non si inizializza (es. tessdata non trovato, o su
+    Windows dove conta solo ``tesseract_cmd`` di pytesseract) si passa a
+    pytesseract per il resto del processo.
+    """
+    global tesserocr
+    if OCR_BINARIZE:
+        img = _binarizza(img)
+    if tesserocr is None:
+        return pytesseract.image_to_string(img)
+    try:
+        api = _tess_apis.get_nowait()
+    except queue.Empty:
+        try:
+            api = tesserocr.PyTessBaseAPI()
+        except Exception as e:
+            logging.warning("tesserocr non utilizzabile (%s), uso pytesseract", e)
+            tesserocr = None
+            return pytesseract.image_to_string(img)
+    try:
+        api.SetImage(img)
+        # Stesso separatore di pagina ("\f") che aggiunge la CLI di tesseract
+        return api.GetUTF8Text() + "\f"
+    finally:
+        _tess_apis.put(api)
+
+
+def _extract_text(convert: Callable[..., List]) -> str:
+    """Converte il PDF in immagini con ``convert`` ed esegue l'OCR pagina per pagina."""
     try:
         # Conversione PDF → Immagini con poppler_path forzato
         try:
             # F.Bechelli | Codice proposto da Roo (funziona in locale, da verificare su 249)
             poppler_path = os.environ.get('POPPLER_PATH', r'C:\Program Files\poppler\bin')
-            images = convert_from_path(
-                pdf_path,
-                dpi=300,
-                poppler_path=poppler_path
+            images = convert(
+                dpi=OCR_DPI,
+                grayscale=True,
+                poppler_path=poppler_path,
+                thread_count=OCR_WORKERS
             )
         except Exception as conv_err:
             raise RuntimeError(
@@ -32,9 +145,51 @@ def extract_text_from_pdf(pdf_path: str) -> str:
                 "   - chocolatey: choco install poppler\n"
                 "   - Manual download: https://github.com/oschwartz10612/poppler-windows/releases"
             )
-        text = ""
-        for img in images:
-            text += pytesseract.image_to_string(img)
-        return text
+        if len(images) <= 1 or OCR_WORKERS <= 1:
+            return "".join(_ocr_image(img) for img in images)
+        # map mantiene l'ordine delle pagine
+        with ThreadPoolExecutor(max_workers=min(OCR_WORKERS, len(images))) as executor:
+            return "".join(executor.map(_ocr_image, images))
     except Exception as e:
-        raise RuntimeError(f"Errore durante l'OCR: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"Errore durante l'OCR: {str(e)}")
+
+
+def _extract_text_cached(content: bytes, convert: Callable[..., List]) -> str:
+    """OCR con cache (``extraction_cache``) sull'hash del PDF e sulla configurazione dell'OCR.
+
+    Lo stesso PDF elaborato con un altro modello o prompt non ripete l'OCR.
+    """
+    key = extraction_cache.make_key(
+        "ocr", str(OCR_DPI), str(OCR_BINARIZE), "tesserocr" if tesserocr else "pytesseract",
+        "pdfium" if pdfium else "poppler",
+        extraction_cache.content_hash(content),
+    )
+    cached = extraction_cache.get(key)
+    if isinstance(cached, str):
+        return cached
+    text = _extract_text(convert)
+    extraction_cache.set(key, text)
+    return text
+
+
+@lru_cache(maxsize=32)
+def _extract_text_from_file(pdf_path: str, mtime_ns: int, size: int) -> str:
+    """OCR di un file, memorizzato per (percorso, data di modifica, dimensione)."""
+    # Il file viene letto solo per calcolarne l'hash: la conversione parte dal percorso
+    with open(pdf_path, "rb") as f:
+        content = f.read()
+    convert = partial(_convert_pdfium, pdf_path) if pdfium else partial(convert_from_path, pdf_path)
+    return _extract_text_cached(content, convert)
+
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    # Primo livello in memoria: un file non modificato non viene nemmeno
+    # riletto; il secondo livello (su disco, per hash) vale tra processi
+    st = os.stat(pdf_path)
+    return _extract_text_from_file(pdf_path, st.st_mtime_ns, st.st_size)
+
+
+def extract_text_from_pdf_bytes(content: bytes) -> str:
+    """Come extract_text_from_pdf, ma a partire dal contenuto del PDF già in memoria."""
+    convert = partial(_convert_pdfium, content) if pdfium else partial(convert_from_bytes, content)
+    return _extract_text_cached(content, convert)
\ No newline at end of file
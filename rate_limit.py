@@ -0,0 +1,71 @@
+"""
+rate_limit.py
+=============
+
+Token bucket condiviso per limitare le chiamate in uscita (LLM e Cleverp).
+
+Ogni chiamata prenota un token: se il secchio è vuoto la prenotazione va
+"in debito" e il chiamante attende il tempo necessario a ricaricarlo.  Lo
+stesso limitatore può essere usato sia da codice sincrono (``acquire``)
+sia da coroutine (``acquire_async``), perché lo stato è protetto da un
+``threading.Lock`` e l'attesa avviene fuori dal lock.
+
+I limiti (richieste al secondo) si configurano con ``CLEVERP_RATE_LIMIT``
+e ``LLM_RATE_LIMIT``; il valore ``0`` disattiva il limite.  Il limite vale
+per processo: con più worker il totale è la somma dei singoli limiti.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+
+class TokenBucket:
+    """Limitatore a secchio di token: ``rate`` richieste al secondo, burst pari a ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Prenota un token e restituisce i secondi da attendere prima di usarlo."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+cleverp_limit = TokenBucket(float(os.getenv("CLEVERP_RATE_LIMIT", "50")))
+llm_limit = TokenBucket(float(os.getenv("LLM_RATE_LIMIT", "30")))
@@ -21,13 +21,34 @@ importare le funzioni necessarie, ad esempio:
                                _get_header_rows, _get_body_rows, _get_cells,
                                _get_layout, _get_text_anchor,
                                _get_text_segments, _extract_text_from_segments,
-                               _cell_text, _parse_number)
+                               _cell_text, _canon, _parse_number,
+                               _pb_type, _pb_mention, _pb_cell_text)
+
+Gli helper ``_pb_*`` lavorano direttamente sul messaggio protobuf
+sottostante (``Document._pb``), senza controlli sul tipo né ripieghi sui
+nomi camelCase.
 
 Queste funzioni sono state pensate per supportare la funzione
 ``rimappa_json``
 """
 
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+# Cella con un solo numero, eventualmente preceduto da un simbolo di valuta e
+# seguito da valuta, "%" o unità di misura ("€ 12,00", "3,5 pz", "10%").
+# Celle con più gruppi di cifre ("2 x 6", "1/2", "N. 5") non corrispondono
+_NUM_CELL_RE = re.compile(r"[\s€$£]*(-?[\d.,]*\d[\d.,]*)\s*([€$£%]|[^\W\d_]+\.?)?\s*")
+# Punto delle migliaia eliminato e virgola decimale convertita in punto, in un solo passaggio
+_NUM_TRANSLATE = str.maketrans({".": None, ",": "."})
+# Numero valido dopo la pulizia: verificato prima di float() per non pagare un'eccezione sui valori non numerici
+_NUM_RE = re.compile(r"-?(?:\d+\.?\d*|\.\d+)")
+# Vocali accentate senza accento e apostrofi eliminati, per confrontare i nomi
+_CANON_TBL = str.maketrans({
+    "à": "a", "è": "e", "é": "e", "ì": "i", "ò": "o", "ù": "u",
+    "'": None, "’": None,
+})
 
 
 def _getattr(obj: Any, attr: str, default: Optional[Any] = None) -> Any:
@@ -44,126 +65,237 @@ def _getattr(obj: Any, attr: str, default: Optional[Any] = None) -> Any:
     return getattr(obj, attr, default)
 
 
+def _field(obj: Any, aliases: Sequence[str], default: Any = None) -> Any:
+    """Restituisce il primo valore non vuoto tra i nomi ``aliases`` di ``obj``.
+
+    Come ``_getattr``, ma il controllo ``isinstance(obj, dict)`` viene
+    fatto una volta sola per tutti gli alias (nome snake_case del protobuf
+    e nome camelCase del JSON).  Se nessun alias ha un valore, restituisce
+    ``default``.
+    """
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        for attr in aliases:
+            value = obj.get(attr)
+            if value:
+                return value
+        return default
+    for attr in aliases:
+        value = getattr(obj, attr, None)
+        if value:
+            return value
+    return default
+
+
+# Nomi dei campi (snake_case del protobuf, camelCase del JSON), calcolati una volta
+_ENTITIES = ("entities",)
+_PAGES = ("pages",)
+_TYPE = ("type_", "type")
+_MENTION = ("mention_text", "mentionText")
+_PROPERTIES = ("properties",)
+_TEXT = ("text",)
+_TABLES = ("tables",)
+_HEADER_ROWS = ("header_rows", "headerRows")
+_BODY_ROWS = ("body_rows", "bodyRows")
+_CELLS = ("cells",)
+_LAYOUT = ("layout",)
+_TEXT_ANCHOR = ("text_anchor", "textAnchor")
+_TEXT_SEGMENTS = ("text_segments", "textSegments")
+
+
 def _get_entities(document: Any) -> Sequence[Any]:
     """Restituisce la sequenza di entità dal documento."""
-    return _getattr(document, "entities", []) or []
+    return _field(document, _ENTITIES, [])
 
 
 def _get_pages(document: Any) -> Sequence[Any]:
     """Restituisce la sequenza di pagine dal documento."""
-    return _getattr(document, "pages", []) or []
+    return _field(document, _PAGES, [])
 
 
 def _get_entity_type(entity: Any) -> str:
     """Restituisce il tipo di entità in minuscolo."""
-    return (_getattr(entity, "type_", None) or _getattr(entity, "type", "")).lower()
+    return _field(entity, _TYPE, "").lower()
 
 
 def _get_entity_mention(entity: Any) -> str:
     """Restituisce il testo associato a un'entità."""
-    return (
-        _getattr(entity, "mention_text", None)
-        or _getattr(entity, "mentionText", "")
-        or ""
-    ).strip()
+    return _field(entity, _MENTION, "").strip()
 
 
 def _get_entity_properties(entity: Any) -> Sequence[Any]:
     """Restituisce la sequenza di proprietà di un'entità."""
-    return _getattr(entity, "properties", []) or []
+    return _field(entity, _PROPERTIES, [])
 
 
 def _get_property_type(prop: Any) -> str:
     """Restituisce il tipo di una proprietà in minuscolo."""
-    return (_getattr(prop, "type_", None) or _getattr(prop, "type", "")).lower()
+    return _field(prop, _TYPE, "").lower()
 
 
 def _get_property_mention(prop: Any) -> str:
     """Restituisce il testo associato a una proprietà."""
-    return (
-        _getattr(prop, "mention_text", None)
-        or _getattr(prop, "mentionText", "")
-        or ""
-    ).strip()
+    return _field(prop, _MENTION, "").strip()
 
 
 def _get_document_text(document: Any) -> str:
     """Restituisce il testo completo del documento."""
-    return _getattr(document, "text", "") or ""
+    return _field(document, _TEXT, "")
 
 
 def _get_tables(page: Any) -> Sequence[Any]:
     """Restituisce la sequenza di tabelle presenti in una pagina."""
-    return _getattr(page, "tables", []) or []
+    return _field(page, _TABLES, [])
 
 
 def _get_header_rows(table: Any) -> Sequence[Any]:
     """Restituisce le righe di intestazione della tabella."""
-    return _getattr(table, "header_rows", None) or _getattr(table, "headerRows", []) or []
+    return _field(table, _HEADER_ROWS, [])
 
 
 def _get_body_rows(table: Any) -> Sequence[Any]:
     """Restituisce le righe del corpo della tabella."""
-    return _getattr(table, "body_rows", None) or _getattr(table, "bodyRows", []) or []
+    return _field(table, _BODY_ROWS, [])
 
 
 def _get_cells(row: Any) -> Sequence[Any]:
     """Restituisce le celle di una riga."""
-    return _getattr(row, "cells", []) or []
+    return _field(row, _CELLS, [])
 
 
 def _get_layout(cell: Any) -> Any:
     """Restituisce il layout di una cella."""
-    return _getattr(cell, "layout", {}) or {}
+    return _field(cell, _LAYOUT, {})
 
 
 def _get_text_anchor(layout: Any) -> Any:
     """Restituisce l'ancora di testo di un layout."""
-    return _getattr(layout, "text_anchor", None) or _getattr(layout, "textAnchor", {}) or {}
+    return _field(layout, _TEXT_ANCHOR, {})
 
 
 def _get_text_segments(anchor: Any) -> Sequence[Any]:
     """Restituisce i segmenti di testo dell'ancora."""
-    return _getattr(anchor, "text_segments", None) or _getattr(anchor, "textSegments", []) or []
+    return _field(anchor, _TEXT_SEGMENTS, [])
+
+
+def _segment_bounds(seg: Any) -> Optional[Tuple[int, int]]:
+    """Indici (inizio, fine) di un segmento; ``None`` se non sono numeri validi."""
+    if not isinstance(seg, dict):
+        # Segmenti protobuf: gli indici sono già interi, senza fallback sui nomi camelCase
+        return seg.start_index, seg.end_index
+    # Nel JSON gli indici int64 sono stringhe e i valori a zero possono mancare
+    start = seg.get("start_index")
+    if start is None:
+        start = seg.get("startIndex", 0)
+    end = seg.get("end_index")
+    if end is None:
+        end = seg.get("endIndex", 0)
+    try:
+        return int(start), int(end)
+    except (TypeError, ValueError):
+        return None
 
 
-def _extract_text_from_segments(segments: Iterable[Any], full_text: str) -> str:
+def _extract_text_from_segments(segments: Sequence[Any], full_text: str) -> str:
     """Compone il testo concatenando tutti i segmenti indicati."""
-    text = ""
+    if len(segments) == 1:
+        # Caso più frequente: un solo segmento, nessuna lista da unire
+        bounds = _segment_bounds(segments[0])
+        return full_text[bounds[0]:bounds[1]].strip() if bounds else ""
+    parts = []
+    append = parts.append
     for seg in segments:
-        start = _getattr(seg, "start_index", None)
-        if start is None:
-            start = _getattr(seg, "startIndex", 0)
-        end = _getattr(seg, "end_index", None)
-        if end is None:
-            end = _getattr(seg, "endIndex", 0)
-        try:
-            start = int(start)
-            end = int(end)
-        except Exception:
-            continue
-        text += full_text[start:end]
-    return text.strip()
+        bounds = _segment_bounds(seg)
+        if bounds is not None:
+            append(full_text[bounds[0]:bounds[1]])
+    return "".join(parts).strip()
 
 
 def _cell_text(cell: Any, full_text: str) -> str:
     """Estrae il testo da una cella di tabella."""
-    layout = _get_layout(cell)
-    anchor = _get_text_anchor(layout)
-    segments = _get_text_segments(anchor)
-    return _extract_text_from_segments(segments, full_text) if segments else ""
+    if isinstance(cell, dict):
+        # Celle JSON: layout, ancora e segmenti sono dizionari annidati, letti
+        # senza passare dagli helper generici
+        anchor = (cell.get("layout") or {}).get("textAnchor") or {}
+        segments = anchor.get("textSegments") or anchor.get("text_segments")
+        if not segments:
+            # Dizionari con i nomi snake_case (es. Document.to_dict)
+            anchor = _get_text_anchor(_get_layout(cell))
+            segments = _get_text_segments(anchor)
+    else:
+        segments = _get_text_segments(_get_text_anchor(_get_layout(cell)))
+    if not segments:
+        return ""
+    if len(segments) == 1:
+        # Caso più frequente: un solo segmento, nessuna lista da unire
+        bounds = _segment_bounds(segments[0])
+        return full_text[bounds[0]:bounds[1]].strip() if bounds else ""
+    return _extract_text_from_segments(segments, full_text)
+
+
+def _pb_type(message: Any) -> str:
+    """Tipo in minuscolo di un'entità o proprietà protobuf (``_pb``).
+
+    Nel descrittore generato da proto-plus il campo si chiama ``type_``.
+    """
+    return message.type_.lower()
+
+
+def _pb_mention(message: Any) -> str:
+    """Testo di un'entità o proprietà protobuf (``_pb``)."""
+    return message.mention_text.strip()
+
+
+def _pb_cell_text(cell: Any, full_text: str) -> str:
+    """Come ``_cell_text`` per una cella protobuf (``_pb``): campi letti direttamente."""
+    segments = cell.layout.text_anchor.text_segments
+    if len(segments) == 1:
+        seg = segments[0]
+        return full_text[seg.start_index:seg.end_index].strip()
+    return "".join([full_text[seg.start_index:seg.end_index] for seg in segments]).strip()
+
 
+def _canon(value: str) -> str:
+    """Restituisce la forma canonica di un nome di colonna o proprietà.
 
+    Minuscolo, senza accenti né apostrofi: ``"Quantità"`` e ``"quantita'"``
+    diventano entrambi ``"quantita"``.
+    """
+    return value.strip().lower().translate(_CANON_TBL)
+
+
+@lru_cache(maxsize=4096)
 def _parse_number(value_str: Union[str, None]) -> Optional[float]:
     """Converte una stringa in float, gestendo il formato italiano (virgola).
 
-    Se ``value_str`` è ``None`` o non è convertibile in numero, restituisce
-    ``None``.
+    Il punto è trattato come separatore delle migliaia e la virgola come
+    separatore decimale (``"1.234,50"`` → ``1234.5``); sono ammessi un
+    simbolo di valuta, spazi, ``%`` e un'unità di misura finale
+    (``"€ 12,00"`` → ``12.0``, ``"3,5 pz"`` → ``3.5``).  Se ``value_str`` è
+    ``None``, non è convertibile in numero o contiene più numeri
+    (``"2 x 6"``), restituisce ``None``.
+
+    I risultati sono memorizzati: quantità e prezzi si ripetono spesso tra
+    le celle di una fattura.
     """
     if not value_str:
         return None
+    # Caso più frequente (quantità intere): nessuna pulizia necessaria.
+    # isdecimal, a differenza di isdigit, esclude caratteri come "²" che float() rifiuta
+    if value_str.isdecimal():
+        return float(value_str)
+    cleaned = value_str.translate(_NUM_TRANSLATE)
+    if _NUM_RE.fullmatch(cleaned):
+        return float(cleaned)
+    match = _NUM_CELL_RE.fullmatch(value_str)
+    unit = match.group(2) if match else None
+    # L'unità deve essere fatta di lettere: "29²" non è "29"
+    if match and (not unit or unit in "€$£%" or unit.rstrip(".").isalpha()):
+        cleaned = match.group(1).translate(_NUM_TRANSLATE)
+        return float(cleaned) if _NUM_RE.fullmatch(cleaned) else None
+    # Altre forme accettate da float() (es. "1e3"), come prima della pulizia
     try:
-        cleaned = value_str.replace(".", "").replace(",", ".")
         return float(cleaned)
-    except Exception:
+    except ValueError:
         return None
\ No newline at end of file